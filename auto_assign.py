@@ -5,12 +5,29 @@
 ### Last updated: 2024/12/12
 ###
 
+import abc
+import contextlib
 import csv
-import networkx as nx
-import argparse
+from array import array
+import hashlib
+import heapq
+import json
+import logging
+import os
+import struct
+import sys
+import time
+import zipfile
+import numpy as np
+
+# networkx and concurrent.futures are imported where they are used: only the
+# networkx backends and parallel jobs need them, and importing them up front
+# roughly doubles the CLI's startup time
 
 PREFERENCE_WEIGHTS = {'1st': 0, '2nd': 1, '3rd': 2}
-DAYS = frozenset(['mon', 'tue', 'wed', 'thu']) 
+
+# Places per activity per day unless a capacities file says otherwise
+DEFAULT_CAPACITY = 15
 
 STUDENT_WEIGHTS = {
     'high': 1,      # Will be assigned first
@@ -18,329 +35,2293 @@ STUDENT_WEIGHTS = {
     'low': 1000    # Will be assigned last
 }
 
+# Progress and errors go through this logger. It stays silent unless the
+# application configures logging (main() does, see configure_logging).
+logger = logging.getLogger('auto_assign')
+logger.addHandler(logging.NullHandler())
+
+LOG_LEVELS = ['debug', 'info', 'warning', 'error']
+
+def configure_logging(level='info', stream=None):
+    # Plain messages on stdout, the same lines the CLI has always printed
+    handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.handlers = [handler]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    return handler
+
+@contextlib.contextmanager
+def muted_progress():
+    # Drops info messages (warnings and errors still pass) for the duration
+    previous = logger.level
+    logger.setLevel(max(logger.getEffectiveLevel(), logging.WARNING))
+    try:
+        yield
+    finally:
+        logger.setLevel(previous)
+
+# Flow network nodes are contiguous ints; source and sink are always 0 and 1
+SOURCE = 0
+SINK = 1
+
+# Node kinds; SOURCE and SINK are the only terminal nodes
+NODE_TERMINAL = 0
+NODE_STUDENT_DAY = 1
+NODE_DAY_ACTIVITY = 2
+
+class NodeIndex:
+    # Integer node ids over a PreferenceTable: one student-day node per table
+    # row and one day-activity node per (day code, activity code) pair. The
+    # per-node row and activity lists let FlowNetwork index its choice edges.
+    def __init__(self, table):
+        self.table = table
+        self.node_kind = [NODE_TERMINAL, NODE_TERMINAL]
+        self.node_row = [-1, -1]
+        self.node_activity = [-1, -1]
+        self._row_nodes = [-1] * len(table)
+        self._day_activity_nodes = {}
+
+    def __len__(self):
+        return len(self.node_kind)
+
+    def _add_node(self, kind, row, activity):
+        node = len(self.node_kind)
+        self.node_kind.append(kind)
+        self.node_row.append(row)
+        self.node_activity.append(activity)
+        return node
+
+    def student_day(self, row):
+        node = self._row_nodes[row]
+        if node < 0:
+            node = self._add_node(NODE_STUDENT_DAY, row, -1)
+            self._row_nodes[row] = node
+        return node
+
+    def day_activity(self, day, activity):
+        key = (day, activity)
+        node = self._day_activity_nodes.get(key)
+        if node is None:
+            node = self._add_node(NODE_DAY_ACTIVITY, -1, activity)
+            self._day_activity_nodes[key] = node
+        return node
+
+class FlowNetwork:
+    # Edge-list flow network over NodeIndex node ids. Adding an existing (u, v)
+    # edge again overwrites it, the same way nx.DiGraph.add_edge does.
+    # Student-day -> day-activity edges are also indexed as they are added
+    # (edge id, table row, activity code), so results can be decoded without
+    # scanning the source and sink edges.
+    def __init__(self, index):
+        self.index = index
+        self.tail = []
+        self.head = []
+        self.capacity = []
+        self.weight = []
+        self._edge_ids = {}
+        self.choice_edges = []
+        self.choice_rows = []
+        self.choice_activities = []
+
+    @property
+    def num_nodes(self):
+        return len(self.index)
+
+    @property
+    def num_edges(self):
+        return len(self.tail)
+
+    def count_nodes(self):
+        # Nodes actually used by this network; the NodeIndex may be shared
+        return len(set(self.tail).union(self.head))
+
+    def add_edge(self, u, v, capacity, weight=0):
+        edge = self._edge_ids.get((u, v))
+        if edge is None:
+            edge = len(self.tail)
+            self._edge_ids[(u, v)] = edge
+            self.tail.append(u)
+            self.head.append(v)
+            self.capacity.append(capacity)
+            self.weight.append(weight)
+            kind = self.index.node_kind
+            if kind[u] == NODE_STUDENT_DAY and kind[v] == NODE_DAY_ACTIVITY:
+                self.choice_edges.append(edge)
+                self.choice_rows.append(self.index.node_row[u])
+                self.choice_activities.append(self.index.node_activity[v])
+        else:
+            self.capacity[edge] = capacity
+            self.weight[edge] = weight
+        return edge
+
+    def decode_flow(self, edge_flow):
+        # (rows, activity codes) of the student-day -> activity edges that
+        # carry flow, visiting only the indexed choice edges
+        rows = []
+        activities = []
+        for edge, row, activity in zip(self.choice_edges, self.choice_rows, self.choice_activities):
+            if edge_flow[edge] > 0:
+                rows.append(row)
+                activities.append(activity)
+        return rows, activities
+
+    def to_networkx(self):
+        import networkx as nx
+        G = nx.DiGraph()
+        G.add_node(SOURCE)
+        G.add_node(SINK)
+        for u, v, capacity, weight in zip(self.tail, self.head, self.capacity, self.weight):
+            G.add_edge(u, v, capacity=capacity, weight=weight)
+        return G
+
+def networkx_max_flow(network):
+    import networkx as nx
+    flow_value, flow_dict = nx.maximum_flow(network.to_networkx(), SOURCE, SINK)
+    edge_flow = [flow_dict[u][v] for u, v in zip(network.tail, network.head)]
+    return flow_value, edge_flow
+
+def _build_residual_arrays(network):
+    # CSR residual graph: edge e becomes arc 2e (forward) and arc 2e + 1 (reverse),
+    # then arcs are grouped by tail so each node's arcs are contiguous
+    n = network.num_nodes
+    m = network.num_edges
+    tail = np.asarray(network.tail, dtype=np.int64)
+    head = np.asarray(network.head, dtype=np.int64)
+
+    arc_tail = np.empty(2 * m, dtype=np.int64)
+    arc_tail[0::2] = tail
+    arc_tail[1::2] = head
+    arc_head = np.empty(2 * m, dtype=np.int64)
+    arc_head[0::2] = head
+    arc_head[1::2] = tail
+    arc_capacity = np.zeros(2 * m, dtype=np.int64)
+    arc_capacity[0::2] = np.asarray(network.capacity, dtype=np.int64)
+    arc_cost = np.empty(2 * m, dtype=np.int64)
+    arc_cost[0::2] = np.asarray(network.weight, dtype=np.int64)
+    arc_cost[1::2] = -arc_cost[0::2]
+
+    order = np.argsort(arc_tail, kind='stable')
+    position = np.empty(2 * m, dtype=np.int64)
+    position[order] = np.arange(2 * m, dtype=np.int64)
+    start = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(arc_tail, minlength=n), out=start[1:])
+
+    return (
+        start.tolist(),
+        arc_head[order].tolist(),
+        position[order ^ 1].tolist(),
+        arc_capacity[order].tolist(),
+        arc_cost[order].tolist(),
+        position[0::2].tolist(),
+    )
+
+def _level_graph(start, to, residual, n, allowed=None):
+    # BFS from the source over arcs with residual capacity (and, if given,
+    # only over arcs flagged in allowed); returns None if the sink is unreachable
+    level = [-1] * n
+    level[SOURCE] = 0
+    queue = [SOURCE]
+    for u in queue:
+        next_level = level[u] + 1
+        for arc in range(start[u], start[u + 1]):
+            v = to[arc]
+            if residual[arc] > 0 and level[v] < 0 and (allowed is None or allowed[arc]):
+                level[v] = next_level
+                queue.append(v)
+    if level[SINK] < 0:
+        return None
+    return level
+
+def _blocking_flow(start, to, rev, residual, level, allowed=None):
+    # Iterative DFS with per-node current-arc pointers; level is consumed
+    pushed_total = 0
+    current = start[:len(level)]
+    path = []
+    u = SOURCE
+    while True:
+        if u == SINK:
+            pushed = min(residual[arc] for arc in path)
+            for arc in path:
+                residual[arc] -= pushed
+                residual[rev[arc]] += pushed
+            pushed_total += pushed
+            path = []
+            u = SOURCE
+            continue
+        end = start[u + 1]
+        arc = current[u]
+        while arc < end and (
+            residual[arc] <= 0
+            or level[to[arc]] != level[u] + 1
+            or (allowed is not None and not allowed[arc])
+        ):
+            arc += 1
+        current[u] = arc
+        if arc < end:
+            path.append(arc)
+            u = to[arc]
+        else:
+            # Dead end: drop u from this phase and retreat one step
+            level[u] = -1
+            if not path:
+                return pushed_total
+            arc = path.pop()
+            current[to[rev[arc]]] += 1
+            u = to[rev[arc]]
+
+def _edge_flow(network, residual, forward_arc):
+    return [
+        capacity - residual[arc]
+        for capacity, arc in zip(network.capacity, forward_arc)
+    ]
+
+def dinic_max_flow(network):
+    n = network.num_nodes
+    start, to, rev, residual, _, forward_arc = _build_residual_arrays(network)
+    flow_value = 0
+    while True:
+        level = _level_graph(start, to, residual, n)
+        if level is None:
+            break
+        flow_value += _blocking_flow(start, to, rev, residual, level)
+    return flow_value, _edge_flow(network, residual, forward_arc)
+
+def primal_dual_min_cost_flow(network):
+    # Min-cost max-flow: Dijkstra on reduced costs finds the current shortest
+    # path length, then a Dinic blocking flow saturates every path of that
+    # length at once. Edge weights must be non-negative.
+    n = network.num_nodes
+    start, to, rev, residual, cost, forward_arc = _build_residual_arrays(network)
+    potential = [0] * n
+    flow_value = 0
+    infinity = float('inf')
+
+    while True:
+        dist = [infinity] * n
+        dist[SOURCE] = 0
+        heap = [(0, SOURCE)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            base = d + potential[u]
+            for arc in range(start[u], start[u + 1]):
+                if residual[arc] > 0:
+                    v = to[arc]
+                    nd = base + cost[arc] - potential[v]
+                    if nd < dist[v]:
+                        dist[v] = nd
+                        heapq.heappush(heap, (nd, v))
+        if dist[SINK] == infinity:
+            break
+
+        limit = dist[SINK]
+        for v in range(n):
+            potential[v] += min(dist[v], limit)
+
+        # Arcs on shortest paths have zero reduced cost; so do their reverses,
+        # so the mask stays valid while the blocking flows update residuals
+        allowed = [False] * len(to)
+        for u in range(n):
+            pu = potential[u]
+            for arc in range(start[u], start[u + 1]):
+                if cost[arc] + pu == potential[to[arc]]:
+                    allowed[arc] = True
+        while True:
+            level = _level_graph(start, to, residual, n, allowed)
+            if level is None:
+                break
+            flow_value += _blocking_flow(start, to, rev, residual, level, allowed)
+
+    return flow_value, _edge_flow(network, residual, forward_arc)
+
+def networkx_min_cost_flow(network):
+    import networkx as nx
+    flow_dict = nx.max_flow_min_cost(network.to_networkx(), SOURCE, SINK)
+    edge_flow = [flow_dict[u][v] for u, v in zip(network.tail, network.head)]
+    return sum(flow_dict[SOURCE].values()), edge_flow
+
+def flow_cost(network, edge_flow):
+    return sum(weight * flow for weight, flow in zip(network.weight, edge_flow))
+
+def bucket_fill(buckets, remaining):
+    # Item i wants one place in bucket buckets[i]; each bucket takes its first
+    # remaining[bucket] items in item order, so earlier items win ties.
+    # Returns the mask of accepted items.
+    buckets = np.asarray(buckets, dtype=np.int64)
+    order = np.argsort(buckets, kind='stable')
+    sorted_buckets = buckets[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_buckets[1:] != sorted_buckets[:-1])))
+    rank = np.arange(len(buckets)) - np.repeat(starts, np.diff(np.append(starts, len(buckets))))
+    accepted = np.zeros(len(buckets), dtype=bool)
+    accepted[order] = rank < remaining[sorted_buckets]
+    return accepted
+
+def bucket_fill_max_flow(network):
+    # Fast path for single-choice rounds: every student-day has one unit
+    # source edge and at most one unit activity edge, so the max flow is a
+    # per-activity bucket fill. Student-days are taken in edge order, so
+    # earlier rows win ties. Returns None when the network does not have that
+    # shape.
+    kind = network.index.node_kind
+    capacity = network.capacity
+    source_edges = {}
+    choice_edges = {}
+    sink_edges = {}
+    for edge, (u, v) in enumerate(zip(network.tail, network.head)):
+        if u == SOURCE and kind[v] == NODE_STUDENT_DAY:
+            if capacity[edge] != 1:
+                return None
+            source_edges[v] = edge
+        elif kind[u] == NODE_STUDENT_DAY and kind[v] == NODE_DAY_ACTIVITY:
+            if u in choice_edges or capacity[edge] != 1:
+                return None
+            choice_edges[u] = edge
+        elif kind[u] == NODE_DAY_ACTIVITY and v == SINK:
+            sink_edges[u] = edge
+        else:
+            return None
+
+    # Buckets are the activity nodes, holding their sink edge capacity
+    remaining = np.zeros(len(network.index), dtype=np.int64)
+    for node, edge in sink_edges.items():
+        remaining[node] = capacity[edge]
+    fed = [(source_edges[node], edge) for node, edge in choice_edges.items() if node in source_edges]
+    source = np.array([source_edge for source_edge, _ in fed], dtype=np.int64)
+    choice = np.array([edge for _, edge in fed], dtype=np.int64)
+    activity_nodes = np.array(network.head, dtype=np.int64)[choice]
+    accepted = bucket_fill(activity_nodes, remaining)
+
+    edge_flow = np.zeros(network.num_edges, dtype=np.int64)
+    edge_flow[source[accepted]] = 1
+    edge_flow[choice[accepted]] = 1
+    sink = np.array([sink_edges[node] for node in activity_nodes[accepted].tolist()], dtype=np.int64)
+    np.add.at(edge_flow, sink, 1)
+    return int(accepted.sum()), edge_flow.tolist()
+
+FLOW_BACKENDS = {
+    'dinic': dinic_max_flow,
+    'networkx': networkx_max_flow,
+}
+
+DEFAULT_FLOW_BACKEND = 'dinic'
+
+# Min-cost flow engines for the global mode, keyed by the same backend names
+MIN_COST_FLOW_BACKENDS = {
+    'dinic': primal_dual_min_cost_flow,
+    'networkx': networkx_min_cost_flow,
+}
+
+# greedy: nine priority x preference max-flow rounds; global: one min-cost
+# max-flow; compare: run both and report them side by side
+SOLVER_MODES = ['greedy', 'global', 'compare']
+
+# Only the global min-cost solve uses the weighted network from
+# build_flow_network; the greedy rounds build their own per-round networks
+GRAPH_MODES = frozenset(['global', 'compare'])
+
+def solve_max_flow(network, backend=DEFAULT_FLOW_BACKEND, check_backend=None, fast_path=True):
+    solution = bucket_fill_max_flow(network) if fast_path else None
+    if solution is None:
+        solution = FLOW_BACKENDS[backend](network)
+    flow_value, edge_flow = solution
+    if check_backend is not None and check_backend != backend:
+        reference_value, _ = FLOW_BACKENDS[check_backend](network)
+        if reference_value != flow_value:
+            raise RuntimeError(
+                f"{backend} max flow {flow_value} does not match {check_backend} max flow {reference_value}"
+            )
+    return flow_value, edge_flow
+
+class Instrumentation:
+    # Collects one record per phase of a run (wall time plus whatever counts
+    # the phase adds), in the order the phases start
+    def __init__(self):
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name, **fields):
+        record = {'phase': name, **fields}
+        self.phases.append(record)
+        start_time = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start_time
+
+    def report(self, **extra):
+        return {'phases': self.phases, **extra}
+
+    def write_json(self, path, **extra):
+        with open(path, mode='w') as file:
+            json.dump(self.report(**extra), file, indent=2)
+
+def print_phase_timings(instrumentation):
+    print("\nPhase Timings:")
+    print("=" * 80)
+    print(f"{'Phase':<40} | {'Time (s)':^10} | {'Details':<25}")
+    print("-" * 80)
+    for record in instrumentation.phases:
+        details = ', '.join(
+            f"{key}={value}" for key, value in record.items()
+            if key not in ('phase', 'seconds') and not isinstance(value, list)
+        )
+        print(f"{record['phase']:<40} | {record.get('seconds', 0.0):^10.4f} | {details:<25}")
+
+class StudentDay:
+    # One student's 1st/2nd/3rd choices for one day
+    __slots__ = ('day', 'first', 'second', 'third')
+
+    def __init__(self, day, first, second, third):
+        self.day = day
+        self.first = first
+        self.second = second
+        self.third = third
+
+    @property
+    def choices(self):
+        return (self.first, self.second, self.third)
+
+    def __eq__(self, other):
+        return isinstance(other, StudentDay) and (self.day, *self.choices) == (other.day, *other.choices)
+
+    def __repr__(self):
+        return f"StudentDay({self.day!r}, {self.first!r}, {self.second!r}, {self.third!r})"
+
+class Student:
+    # A student's priority ('weight') and their StudentDay records in first-seen
+    # day order; a later record for the same day replaces the earlier one
+    __slots__ = ('student_id', 'weight', 'days')
+
+    def __init__(self, student_id, weight='medium', days=None):
+        self.student_id = student_id
+        self.weight = weight
+        self.days = days if days is not None else []
+
+    def set_day(self, student_day):
+        for position, existing in enumerate(self.days):
+            if existing.day == student_day.day:
+                self.days[position] = student_day
+                return
+        self.days.append(student_day)
+
+    def __eq__(self, other):
+        return (isinstance(other, Student) and self.student_id == other.student_id
+                and self.weight == other.weight and self.days == other.days)
+
+    def __repr__(self):
+        return f"Student({self.student_id!r}, {self.weight!r}, {self.days!r})"
+
 def load_student_preferences(csv_file):
+    # student_id -> Student. Day and activity names are shared between
+    # records instead of being kept once per row.
     preferences = {} 
+    names = {}
     try:
-        with open(csv_file, mode='r') as file:
-            reader = csv.DictReader(file)
+        with open(csv_file, mode='r', newline='') as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            student_column = header.index('student_id')
+            day_column = header.index('day')
+            first_column = header.index('1st_preference')
+            second_column = header.index('2nd_preference')
+            third_column = header.index('3rd_preference')
+            priority_column = header.index('priority') if 'priority' in header else None
             for row in reader:
-                student_id = row['student_id']
-                if student_id not in preferences:
-                    preferences[student_id] = {
-                        'weight': row.get('priority', 'medium'),  # Default to medium if not specified
-                        'days': {}
-                    }
+                if not row:
+                    continue
+                student_id = row[student_column]
+                student = preferences.get(student_id)
+                if student is None:
+                    # Default to medium if not specified
+                    weight = row[priority_column] if priority_column is not None else 'medium'
+                    student = preferences[student_id] = Student(student_id, names.setdefault(weight, weight))
                 
-                day = row['day'].strip().lower()
-                preferences[student_id]['days'][day] = {
-                    '1st_preference': row['1st_preference'].strip(),
-                    '2nd_preference': row['2nd_preference'].strip(),
-                    '3rd_preference': row['3rd_preference'].strip(),
-                }
-        print(f"Loaded {len(preferences)} student preferences.")
+                day = row[day_column].strip().lower()
+                first = row[first_column].strip()
+                second = row[second_column].strip()
+                third = row[third_column].strip()
+                student.set_day(StudentDay(
+                    names.setdefault(day, day),
+                    names.setdefault(first, first),
+                    names.setdefault(second, second),
+                    names.setdefault(third, third),
+                ))
+        logger.info(f"Loaded {len(preferences)} student preferences.")
     except Exception as e:
-        print(f"Error loading CSV file: {e}")
+        logger.error(f"Error loading CSV file: {e}")
     return preferences
 
-# assign 15 as the maximum capacity per activity per day as a test, can be assigned individually in a real scenario 
-def build_flow_network(preferences, days, max_capacity_per_activity=15):
-    G = nx.DiGraph()
-    
-    G.add_node('source')
-    G.add_node('sink')
-
-    activities_by_day = {day: set() for day in days}
-    for student_prefs in preferences.values():
-        for day, prefs in student_prefs['days'].items():
-            activities_by_day[day].update([
-                prefs['1st_preference'],
-                prefs['2nd_preference'],
-                prefs['3rd_preference']
-            ])
+PRIORITY_LEVELS = list(STUDENT_WEIGHTS)
+PREFERENCE_LEVELS = ['1st', '2nd', '3rd']
 
-    # Modified to give strict priority based on student weights
-    for student_id, student_data in preferences.items():
-        student_weight = STUDENT_WEIGHTS[student_data['weight']]
-        for day, prefs in student_data['days'].items():
-            student_day_node = f"{student_id}_{day}"
-            G.add_edge('source', student_day_node, capacity=1, weight=0)
-            
-            for pref_type, activity in prefs.items():
-                # Base weight from preference order
-                base_weight = PREFERENCE_WEIGHTS[pref_type.split('_')[0]]
-                # Multiply by student priority weight to ensure strict ordering
-                edge_weight = base_weight + student_weight
-                G.add_edge(
-                    student_day_node,
-                    f"{day}_{activity}",
-                    capacity=1,
-                    weight=edge_weight
+def _intern(value, codes, table):
+    code = codes.get(value)
+    if code is None:
+        code = len(table)
+        codes[value] = code
+        table.append(value)
+    return code
+
+class PreferenceTable:
+    # Columnar student preferences with one row per student-day. Student ids,
+    # days and activities are dictionary-encoded: the row columns hold codes
+    # into the student_ids / days / activities string tables, choices holds the
+    # 1st/2nd/3rd activity codes and priority indexes PRIORITY_LEVELS.
+    # Rows are grouped by student in first-seen order, like the nested dict,
+    # so student codes never decrease along the rows.
+    def __init__(self, student_ids, days, activities, student, day, choices, priority):
+        self.student_ids = student_ids
+        self.days = days
+        self.activities = activities
+        self.student = student
+        self.day = day
+        self.choices = choices
+        self.priority = priority
+
+    def __len__(self):
+        return len(self.student)
+
+    @property
+    def num_students(self):
+        return len(self.student_ids)
+
+    @property
+    def nbytes(self):
+        return self.student.nbytes + self.day.nbytes + self.choices.nbytes + self.priority.nbytes
+
+    def student_priority(self):
+        priority = np.zeros(self.num_students, dtype=np.int8)
+        priority[self.student] = self.priority
+        return priority
+
+    def rows_with_priority(self, priority):
+        return np.flatnonzero(self.priority == PRIORITY_LEVELS.index(priority))
+
+    def row_lookup(self):
+        # Maps (student id, day) to row numbers, for callers holding string keys
+        student_codes = {student_id: code for code, student_id in enumerate(self.student_ids)}
+        day_codes = {day: code for code, day in enumerate(self.days)}
+        num_days = max(len(self.days), 1)
+        keys = self.student.astype(np.int64) * num_days + self.day
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+
+        def lookup(student_id, day):
+            key = student_codes[student_id] * num_days + day_codes[day]
+            position = np.searchsorted(sorted_keys, key)
+            if position == len(sorted_keys) or sorted_keys[position] != key:
+                raise KeyError((student_id, day))
+            return int(order[position])
+        return lookup
+
+    def decode_assignments(self, assigned):
+        # assigned holds an activity code per row, or -1 when unassigned
+        assignments = {}
+        rows = np.flatnonzero(assigned >= 0)
+        for student, day, activity in zip(
+            self.student[rows].tolist(), self.day[rows].tolist(), assigned[rows].tolist()
+        ):
+            student_id = self.student_ids[student]
+            if student_id not in assignments:
+                assignments[student_id] = {}
+            assignments[student_id][self.days[day]] = self.activities[activity]
+        return assignments
+
+    def encode_assignments(self, assignments):
+        activity_codes = {activity: code for code, activity in enumerate(self.activities)}
+        lookup = self.row_lookup()
+        assigned = np.full(len(self), -1, dtype=np.int32)
+        for student_id, daily_activities in assignments.items():
+            for day, activity in daily_activities.items():
+                assigned[lookup(student_id, day)] = activity_codes[activity]
+        return assigned
+
+    def take(self, rows, solver_only=False):
+        # Table restricted to the given rows, sharing the string tables. With
+        # solver_only the student id table is left out, which is all the
+        # priority rounds need and keeps the table cheap to send to a worker.
+        return PreferenceTable(
+            [] if solver_only else self.student_ids,
+            self.days,
+            self.activities,
+            self.student[rows],
+            self.day[rows],
+            self.choices[rows],
+            self.priority[rows],
+        )
+
+    def student_rows(self, student):
+        # Student codes never decrease along the rows, so each student's rows
+        # are one contiguous slice
+        # (searching with the column's own dtype avoids converting the column)
+        student = self.student.dtype.type(student)
+        return np.arange(
+            np.searchsorted(self.student, student, side='left'),
+            np.searchsorted(self.student, student, side='right'),
+        )
+
+    def apply_changes(self, changes):
+        # changes maps student_id to a Student record (its days replace or add
+        # to the student's days), to a dict {'weight': priority (optional),
+        # 'days': {day: prefs or None}} where None withdraws that day, or to
+        # None, which withdraws the student.
+        # Returns the updated table, the row in self each new row came from
+        # (-1 for added rows) and a mask of rows whose preferences or priority
+        # changed (added rows included).
+        student_ids = list(self.student_ids)
+        days = list(self.days)
+        activities = list(self.activities)
+        student_codes = {student_id: code for code, student_id in enumerate(student_ids)}
+        day_codes = {day: code for code, day in enumerate(days)}
+        activity_codes = {activity: code for code, activity in enumerate(activities)}
+
+        keep = np.ones(len(self), dtype=bool)
+        touched = np.zeros(len(self), dtype=bool)
+        choices = self.choices.copy()
+        priority = self.priority.copy()
+        added_student, added_day, added_choices, added_priority = [], [], [], []
+
+        for student_id, entry in changes.items():
+            student = student_codes.get(student_id)
+            rows = self.student_rows(student) if student is not None else np.arange(0)
+            if entry is None:
+                keep[rows] = False
+                continue
+
+            if isinstance(entry, Student):
+                weight = entry.weight
+                day_updates = [(student_day.day, student_day.choices) for student_day in entry.days]
+            else:
+                weight = entry.get('weight')
+                day_updates = [
+                    (day, None if prefs is None else
+                     tuple(prefs[f'{level}_preference'] for level in PREFERENCE_LEVELS))
+                    for day, prefs in entry.get('days', {}).items()
+                ]
+            if weight is not None and weight not in STUDENT_WEIGHTS:
+                raise ValueError(f"Unknown priority {weight!r} for student {student_id}")
+            if student is None:
+                student = _intern(student_id, student_codes, student_ids)
+            if weight is not None:
+                student_priority = PRIORITY_LEVELS.index(weight)
+                changed = rows[priority[rows] != student_priority]
+                priority[changed] = student_priority
+                touched[changed] = True
+            elif len(rows):
+                student_priority = int(priority[rows[0]])
+            else:
+                student_priority = PRIORITY_LEVELS.index('medium')
+
+            for day, day_choices in day_updates:
+                day = _intern(day.strip().lower(), day_codes, days)
+                existing = rows[self.day[rows] == day]
+                if day_choices is None:
+                    keep[existing] = False
+                    continue
+                codes = [_intern(activity.strip(), activity_codes, activities) for activity in day_choices]
+                if len(existing):
+                    choices[existing] = codes
+                    touched[existing] = True
+                else:
+                    added_student.append(student)
+                    added_day.append(day)
+                    added_choices.append(codes)
+                    added_priority.append(student_priority)
+
+        kept = np.flatnonzero(keep)
+        student = np.concatenate((self.student[kept], np.array(added_student, dtype=np.int32)))
+        order = np.argsort(student, kind='stable')
+        source_row = np.concatenate((kept, np.full(len(added_student), -1, dtype=np.int64)))[order]
+        # Re-encode the students so that withdrawn ones (no rows left) drop
+        # out of student_ids; codes stay in first-seen order
+        present, student = np.unique(student[order], return_inverse=True)
+        table = PreferenceTable(
+            [student_ids[code] for code in present.tolist()],
+            days,
+            activities,
+            student.astype(np.int32),
+            np.concatenate((self.day[kept], np.array(added_day, dtype=np.int16)))[order],
+            np.concatenate((choices[kept], np.array(added_choices, dtype=np.int32).reshape(-1, 3)))[order],
+            np.concatenate((priority[kept], np.array(added_priority, dtype=np.int8)))[order],
+        )
+        touched = np.concatenate((touched[kept], np.ones(len(added_student), dtype=bool)))[order]
+        return table, source_row, touched
+
+    def to_preferences(self):
+        # student_id -> Student, the load_student_preferences layout
+        preferences = {}
+        activities = self.activities
+        for student, day, (first, second, third), priority in zip(
+            self.student.tolist(), self.day.tolist(), self.choices.tolist(), self.priority.tolist()
+        ):
+            student_id = self.student_ids[student]
+            record = preferences.get(student_id)
+            if record is None:
+                record = preferences[student_id] = Student(student_id, PRIORITY_LEVELS[priority])
+            record.days.append(StudentDay(self.days[day], activities[first], activities[second], activities[third]))
+        return preferences
+
+    @classmethod
+    def from_preferences(cls, preferences):
+        # Accepts Student records or the older nested dict layout
+        # ({'weight': ..., 'days': {day: {'1st_preference': ...}}})
+        builder = PreferenceTableBuilder()
+        for student_id, student_data in preferences.items():
+            if isinstance(student_data, Student):
+                for student_day in student_data.days:
+                    builder.add(
+                        student_id, student_data.weight, student_day.day,
+                        student_day.first, student_day.second, student_day.third,
+                    )
+                continue
+            for day, prefs in student_data['days'].items():
+                builder.add(
+                    student_id, student_data['weight'], day,
+                    prefs['1st_preference'], prefs['2nd_preference'], prefs['3rd_preference'],
                 )
+        return builder.build()
+
+class PreferenceTableBuilder:
+    # Accumulates rows into flat typed arrays while interning strings, so
+    # nothing per row is kept as a Python object
+    def __init__(self):
+        self.student_ids = []
+        self.days = []
+        self.activities = []
+        self._student_codes = {}
+        self._day_codes = {}
+        self._activity_codes = {}
+        self._student_priority = array('b')
+        self._student = array('i')
+        self._day = array('h')
+        self._choices = array('i')
+
+    def add(self, student_id, priority, day, first, second, third):
+        student = self._student_codes.get(student_id)
+        if student is None:
+            student = len(self.student_ids)
+            self._student_codes[student_id] = student
+            self.student_ids.append(student_id)
+            # A student's priority is taken from their first row
+            if priority not in STUDENT_WEIGHTS:
+                raise ValueError(f"Unknown priority {priority!r} for student {student_id}")
+            self._student_priority.append(PRIORITY_LEVELS.index(priority))
+        self._student.append(student)
+        self._day.append(_intern(day, self._day_codes, self.days))
+        intern = _intern
+        codes = self._activity_codes
+        activities = self.activities
+        self._choices.append(intern(first, codes, activities))
+        self._choices.append(intern(second, codes, activities))
+        self._choices.append(intern(third, codes, activities))
+
+    def build(self):
+        student = np.frombuffer(self._student, dtype=np.int32)
+        day = np.frombuffer(self._day, dtype=np.int16)
+        choices = np.frombuffer(self._choices, dtype=np.int32).reshape(-1, 3)
+        student_priority = np.frombuffer(self._student_priority, dtype=np.int8)
+
+        # A repeated (student, day) row overwrites the earlier one in place,
+        # then rows are grouped by student in first-seen order
+        n = len(student)
+        if n == 0:
+            return PreferenceTable(
+                self.student_ids, self.days, self.activities,
+                student, day, choices, student_priority[student],
+            )
+        keys = student.astype(np.int64) * max(len(self.days), 1) + day
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        boundary = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+        first = order[boundary]
+        last = order[np.append(boundary[1:], n) - 1]
+        position = np.lexsort((first, student[first]))
+        rows = last[position]
+
+        student = student[rows]
+        return PreferenceTable(
+            self.student_ids,
+            self.days,
+            self.activities,
+            student,
+            day[rows],
+            choices[rows],
+            student_priority[student],
+        )
+
+def as_preference_table(preferences):
+    if isinstance(preferences, PreferenceTable):
+        return preferences
+    return PreferenceTable.from_preferences(preferences)
+
+def load_preference_table(csv_file):
+    # Streaming counterpart of load_student_preferences: rows go straight into
+    # columnar arrays instead of a nested dict per student and day
+    table = None
+    try:
+        builder = PreferenceTableBuilder()
+        with open(csv_file, mode='r', newline='') as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            student_column = header.index('student_id')
+            day_column = header.index('day')
+            first_column = header.index('1st_preference')
+            second_column = header.index('2nd_preference')
+            third_column = header.index('3rd_preference')
+            priority_column = header.index('priority') if 'priority' in header else None
+
+            add = builder.add
+            for row in reader:
+                if not row:
+                    continue
+                add(
+                    row[student_column],
+                    row[priority_column] if priority_column is not None else 'medium',  # Default to medium if not specified
+                    row[day_column].strip().lower(),
+                    row[first_column].strip(),
+                    row[second_column].strip(),
+                    row[third_column].strip(),
+                )
+        table = builder.build()
+        logger.info(f"Loaded {table.num_students} student preferences.")
+    except Exception as e:
+        logger.error(f"Error loading CSV file: {e}")
+    return table
+
+SNAPSHOT_VERSION = 1
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, mode='rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _source_key(csv_file):
+    # What a snapshot remembers about the CSV it was built from
+    stat = os.stat(csv_file)
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns,
+            'source_sha256': _file_digest(csv_file)}
+
+def save_preference_snapshot(preferences, snapshot_file, source=None):
+    # Writes the columnar table as an uncompressed .npz: the row columns as
+    # they are and the string tables as fixed-width unicode arrays, so a
+    # reload is a handful of array reads with no parsing. source is the
+    # _source_key of the CSV the table came from. The file is written next
+    # to its final name and renamed into place.
+    table = as_preference_table(preferences)
+    source = source or {'source_size': -1, 'source_mtime_ns': -1, 'source_sha256': ''}
+    temp_file = f"{snapshot_file}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file, mode='wb') as file:
+            np.savez(
+                file,
+                version=np.int64(SNAPSHOT_VERSION),
+                student_ids=np.array(table.student_ids, dtype=str),
+                days=np.array(table.days, dtype=str),
+                activities=np.array(table.activities, dtype=str),
+                student=table.student,
+                day=table.day,
+                choices=table.choices,
+                priority=table.priority,
+                source_size=np.int64(source['source_size']),
+                source_mtime_ns=np.int64(source['source_mtime_ns']),
+                source_sha256=np.array(source['source_sha256']),
+            )
+        os.replace(temp_file, snapshot_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return snapshot_file
+
+class MappedStringTable:
+    # Read-only string table over a memory-mapped fixed-width unicode array.
+    # Entries are decoded when they are accessed, not up front.
+    def __init__(self, strings):
+        self.strings = strings
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, code):
+        return str(self.strings[code])
+
+    def __iter__(self):
+        for start in range(0, len(self.strings), 65536):
+            yield from self.strings[start:start + 65536].tolist()
+
+def _map_snapshot_member(snapshot_file, members, name):
+    # np.load ignores mmap_mode for .npz files, but save_preference_snapshot
+    # stores the members uncompressed, so each .npy can be mapped in place:
+    # skip the zip local header and the .npy header, then map the data
+    info = members.getinfo(f"{name}.npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(f"snapshot member {name} is compressed and cannot be memory-mapped")
+    with open(snapshot_file, mode='rb') as file:
+        file.seek(info.header_offset)
+        local_header = file.read(30)
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        file.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+        offset = file.tell()
+    if not np.prod(shape, dtype=np.int64):
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(snapshot_file, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+def _read_snapshot_source(snapshot_file):
+    with np.load(snapshot_file) as data:
+        if int(data['version']) != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {int(data['version'])}")
+        return {
+            'source_size': int(data['source_size']),
+            'source_mtime_ns': int(data['source_mtime_ns']),
+            'source_sha256': str(data['source_sha256']),
+        }
+
+def _read_snapshot(snapshot_file, mmap=False):
+    # With mmap the row columns and the student id table stay in the file and
+    # are paged in as the solver touches them; days and activities are small
+    # and always read
+    _read_snapshot_source(snapshot_file)
+    if mmap:
+        with zipfile.ZipFile(snapshot_file) as members:
+            return PreferenceTable(
+                MappedStringTable(_map_snapshot_member(snapshot_file, members, 'student_ids')),
+                _map_snapshot_member(snapshot_file, members, 'days').tolist(),
+                _map_snapshot_member(snapshot_file, members, 'activities').tolist(),
+                _map_snapshot_member(snapshot_file, members, 'student'),
+                _map_snapshot_member(snapshot_file, members, 'day'),
+                _map_snapshot_member(snapshot_file, members, 'choices'),
+                _map_snapshot_member(snapshot_file, members, 'priority'),
+            )
+    with np.load(snapshot_file) as data:
+        return PreferenceTable(
+            data['student_ids'].tolist(),
+            data['days'].tolist(),
+            data['activities'].tolist(),
+            data['student'],
+            data['day'],
+            data['choices'],
+            data['priority'],
+        )
+
+def load_preference_snapshot(snapshot_file, mmap=False):
+    table = None
+    try:
+        table = _read_snapshot(snapshot_file, mmap)
+        logger.info(f"Loaded {table.num_students} student preferences from snapshot.")
+    except Exception as e:
+        logger.error(f"Error loading snapshot file: {e}")
+    return table
+
+def snapshot_path(csv_file, cache_dir):
+    # One snapshot per source path, named after the CSV so the cache is
+    # easy to inspect
+    name = os.path.splitext(os.path.basename(csv_file))[0]
+    path_hash = hashlib.sha256(os.path.abspath(csv_file).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{name}-{path_hash}.npz")
+
+def load_preferences_cached(csv_file, cache_dir, mmap=False):
+    # Loads the CSV through a snapshot cache. A snapshot is reused when the
+    # CSV's size and mtime are unchanged, or when they changed but its
+    # SHA-256 did not (e.g. after a copy or touch); otherwise the CSV is
+    # parsed and the snapshot rewritten. With mmap the table is mapped from
+    # the snapshot (see _read_snapshot).
+    snapshot_file = snapshot_path(csv_file, cache_dir)
+    try:
+        stat = os.stat(csv_file)
+        if os.path.exists(snapshot_file):
+            source = _read_snapshot_source(snapshot_file)
+            fresh = source['source_size'] == stat.st_size and source['source_mtime_ns'] == stat.st_mtime_ns
+            if not fresh and source['source_size'] == stat.st_size:
+                fresh = source['source_sha256'] == _file_digest(csv_file)
+                if fresh:
+                    # Same content under a new mtime: remember the new mtime
+                    save_preference_snapshot(_read_snapshot(snapshot_file), snapshot_file, _source_key(csv_file))
+            if fresh:
+                table = _read_snapshot(snapshot_file, mmap)
+                logger.info(f"Loaded {table.num_students} student preferences from snapshot {snapshot_file}.")
+                return table
+    except Exception as e:
+        logger.warning(f"Ignoring snapshot {snapshot_file}: {e}")
+
+    # Key taken before parsing, so a CSV edited mid-load is parsed again next time
+    try:
+        source = _source_key(csv_file)
+    except Exception as e:
+        logger.error(f"Error loading CSV file: {e}")
+        return None
+    table = load_preference_table(csv_file)
+    if table is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            save_preference_snapshot(table, snapshot_file, source)
+            logger.info(f"Wrote snapshot {snapshot_file}.")
+            if mmap:
+                table = _read_snapshot(snapshot_file, mmap)
+        except Exception as e:
+            logger.error(f"Error writing snapshot: {e}")
+    return table
+
+def load_activity_capacities(csv_file):
+    # Reads day,activity,capacity rows into {(day, activity): capacity}; pairs
+    # that are not listed keep the default capacity
+    capacities = {}
+    try:
+        with open(csv_file, mode='r', newline='') as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                day = row['day'].strip().lower()
+                activity = row['activity'].strip()
+                capacity = int(row['capacity'])
+                if capacity < 0:
+                    raise ValueError(f"Negative capacity {capacity} for {activity} on {day}")
+                capacities[(day, activity)] = capacity
+        logger.info(f"Loaded capacities for {len(capacities)} activities.")
+    except Exception as e:
+        logger.error(f"Error loading capacities file: {e}")
+        return None
+    return capacities
+
+def initial_activity_capacity(table, max_capacity_per_activity=DEFAULT_CAPACITY, capacities=None):
+    # Remaining capacity per (day code, activity code); only pairs that appear
+    # in someone's preferences get a capacity. capacities overrides the
+    # default for individual (day, activity) pairs.
+    if max_capacity_per_activity < 0:
+        raise ValueError(f"Negative default capacity {max_capacity_per_activity}")
+    requested = np.zeros((len(table.days), len(table.activities)), dtype=bool)
+    for level in range(len(PREFERENCE_LEVELS)):
+        requested[table.day, table.choices[:, level]] = True
+    capacity = np.where(requested, max_capacity_per_activity, 0).astype(np.int64)
+    if capacities:
+        day_codes = {day: code for code, day in enumerate(table.days)}
+        activity_codes = {activity: code for code, activity in enumerate(table.activities)}
+        for (day, activity), value in capacities.items():
+            if value < 0:
+                raise ValueError(f"Negative capacity {value} for {activity} on {day}")
+            day_code = day_codes.get(day)
+            activity_code = activity_codes.get(activity)
+            if day_code is not None and activity_code is not None and requested[day_code, activity_code]:
+                capacity[day_code, activity_code] = value
+    return capacity
+
+def build_flow_network(preferences, days=None, max_capacity_per_activity=DEFAULT_CAPACITY, capacities=None):
+    # days limits the network to those days; None keeps every day in the table
+    table = as_preference_table(preferences)
+    index = NodeIndex(table)
+    G = FlowNetwork(index)
+
+    if days is None:
+        rows = np.arange(len(table))
+    else:
+        day_codes = [code for code, day in enumerate(table.days) if day in days]
+        rows = np.flatnonzero(np.isin(table.day, day_codes))
+
+    # Activities without capacity get no edges at all
+    activity_capacity = initial_activity_capacity(table, max_capacity_per_activity, capacities)
+
+    # Modified to give strict priority based on student weights
+    student_weights = np.array([STUDENT_WEIGHTS[priority] for priority in PRIORITY_LEVELS])
+    preference_weights = [PREFERENCE_WEIGHTS[level] for level in PREFERENCE_LEVELS]
+    for row, day, choices, student_weight in zip(
+        rows.tolist(),
+        table.day[rows].tolist(),
+        table.choices[rows].tolist(),
+        student_weights[table.priority[rows]].tolist(),
+    ):
+        student_day_node = index.student_day(row)
+        G.add_edge(SOURCE, student_day_node, capacity=1, weight=0)
+
+        for base_weight, activity in zip(preference_weights, choices):
+            if not activity_capacity[day, activity]:
+                continue
+            # Base weight from preference order plus the student priority
+            # weight to ensure strict ordering
+            G.add_edge(
+                student_day_node,
+                index.day_activity(day, activity),
+                capacity=1,
+                weight=base_weight + student_weight
+            )
 
-    for day, activities in activities_by_day.items():
-        for activity in activities:
-            G.add_edge(f"{day}_{activity}", 'sink', capacity=max_capacity_per_activity, weight=0)
+    activity_pairs = np.unique(
+        table.day[rows].astype(np.int64)[:, None] * len(table.activities) + table.choices[rows]
+    )
+    for pair in activity_pairs.tolist():
+        day, activity = divmod(pair, len(table.activities))
+        if activity_capacity[day, activity]:
+            G.add_edge(index.day_activity(day, activity), SINK,
+                       capacity=int(activity_capacity[day, activity]), weight=0)
 
-    print(f"Flow network created with {len(G.nodes)} nodes and {len(G.edges)} edges.")
-    print(f"Source node connections: {len(G['source'])}")
-    print(f"Sink node connections: {len(G.in_edges('sink'))}")
+    logger.info(f"Flow network created with {G.num_nodes} nodes and {G.num_edges} edges.")
+    logger.info(f"Source node connections: {G.tail.count(SOURCE)}")
+    logger.info(f"Sink node connections: {G.head.count(SINK)}")
     return G
 
-def assign_priority_group(priority_students, label, activity_capacity):
-    group_assignments = {}
+class DemandIndex:
+    # Rows of one priority group bucketed by the (day, activity) they ask for
+    # at each preference level, so a round only visits activities that still
+    # have places and student-days that are still unassigned
+    def __init__(self, table, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        num_activities = max(len(table.activities), 1)
+        self.levels = []
+        for level in range(len(PREFERENCE_LEVELS)):
+            keys = table.day[rows].astype(np.int64) * num_activities + table.choices[rows, level]
+            order = np.argsort(keys, kind='stable')
+            bucket_keys, counts = np.unique(keys[order], return_counts=True)
+            self.levels.append((rows[order], bucket_keys, counts))
+
+    def outstanding(self, level, remaining_capacity, unassigned):
+        # Rows in the unassigned set whose choice at this level still has
+        # capacity, in table order; rows asking for a full activity are
+        # skipped a whole bucket at a time
+        rows, bucket_keys, counts = self.levels[level]
+        open_buckets = remaining_capacity.ravel()[bucket_keys] > 0
+        rows = rows[np.repeat(open_buckets, counts)]
+        return np.sort(rows[unassigned[rows]])
+
+def assign_priority_group(table, rows, label, activity_capacity, assigned, index=None,
+                          backend=DEFAULT_FLOW_BACKEND, check_backend=None, fast_path=True,
+                          instrumentation=None, unassigned=None, strict=False):
+    # Fills assigned (activity code per row) for the given rows and returns the
+    # rows that got an assignment. On the fast path (without a cross-check)
+    # each round is a bucket fill straight on the coded arrays; otherwise
+    # every round builds and solves its own network.
+    # unassigned is the boolean mask of outstanding student-days shared by all
+    # rounds; only those rows enter a round and assigned rows leave it.
+    # A round that fails is logged and skipped, or re-raised when strict.
+    group_rows = []
+    if index is None:
+        index = NodeIndex(table)
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    if unassigned is None:
+        unassigned = assigned < 0
+    demand = DemandIndex(table, rows)
     
     # Try each preference level in order
-    for pref_level in ['1st', '2nd', '3rd']:
-        print(f"  Trying {pref_level} preferences for {label} priority...")
-        
-        # Create network for current preference level
-        G_pref = create_priority_network(priority_students, activity_capacity, pref_level)
+    for level, pref_level in enumerate(PREFERENCE_LEVELS):
+        logger.info(f"  Trying {pref_level} preferences for {label} priority...")
         
-        try:
-            # Find maximum flow
-            flow_dict = nx.maximum_flow(G_pref, 'source', 'sink')[1]
-            
-            # Process assignments from flow
-            for node, flows in flow_dict.items():
-                if node != 'source' and '_' in node:
-                    student_id, day = node.split('_')
-                    if student_id.startswith('S'):  # Only process student nodes
-                        for target, flow in flows.items():
-                            if flow > 0 and target != 'sink':
-                                _, activity = target.split('_', 1)
-                                if student_id not in group_assignments:
-                                    group_assignments[student_id] = {}
-                                if day not in group_assignments[student_id]:
-                                    group_assignments[student_id][day] = activity
-                                    activity_capacity[day][activity] -= 1
-            
-        except Exception as e:
-            print(f"  Error in {pref_level} preference assignment: {e}")
-            continue
+        # Only the residual problem: unassigned rows asking for open activities
+        pending = demand.outstanding(level, activity_capacity, unassigned)
+        with instrumentation.phase(f"round {label}/{pref_level}", student_days=len(pending),
+                                   pruned=len(rows) - len(pending)) as phase:
+            if not len(pending):
+                phase.update(flow=0, assigned=0)
+                continue
+
+            if fast_path and check_backend is None:
+                # Each pending row has one candidate activity at this level,
+                # so the round's max flow is a bucket fill over the remaining
+                # (day, activity) capacity
+                buckets = (table.day[pending].astype(np.int64) * activity_capacity.shape[1]
+                           + table.choices[pending, level])
+                new_rows = pending[bucket_fill(buckets, activity_capacity.ravel())]
+                assigned[new_rows] = table.choices[new_rows, level]
+                np.subtract.at(activity_capacity, (table.day[new_rows], assigned[new_rows]), 1)
+                unassigned[new_rows] = False
+                group_rows.extend(new_rows.tolist())
+                phase.update(flow=len(new_rows), assigned=len(new_rows))
+                continue
+
+            # Create network for current preference level
+            network = create_priority_network(table, pending, activity_capacity, pref_level, index, unassigned)
+            phase.update(nodes=network.count_nodes(), edges=network.num_edges)
+
+            try:
+                # Find maximum flow
+                flow_value, edge_flow = solve_max_flow(network, backend, check_backend, fast_path)
+                
+                # Process assignments from flow
+                new_rows = apply_round_flow(table, network, edge_flow, activity_capacity, assigned)
+                unassigned[new_rows] = False
+                group_rows.extend(new_rows)
+                phase.update(flow=flow_value, assigned=len(new_rows))
+                
+            except Exception as e:
+                if strict:
+                    raise
+                logger.error(f"  Error in {pref_level} preference assignment: {e}")
+                phase['error'] = str(e)
+                continue
             
-    return group_assignments
+    return np.array(group_rows, dtype=np.int64)
+
+def apply_round_flow(table, network, edge_flow, activity_capacity, assigned):
+    # Records each student-day that received flow and takes its slot out of
+    # activity_capacity; returns the newly assigned rows. Round networks only
+    # hold unassigned student-days, so every flow is a new assignment.
+    new_rows, activities = network.decode_flow(edge_flow)
+    assigned[new_rows] = activities
+    np.subtract.at(activity_capacity, (table.day[new_rows], assigned[new_rows]), 1)
+    return new_rows
+
+def create_priority_network(table, rows, remaining_capacity, pref_level='1st', index=None, unassigned=None):
+    if index is None:
+        index = NodeIndex(table)
+    G = FlowNetwork(index)
 
-def create_priority_network(priority_students, remaining_capacity, pref_level='1st'):
-    G = nx.DiGraph()
-    G.add_node('source')
-    G.add_node('sink')
+    # Student-days that already have an activity take no part in the round
+    rows = np.asarray(rows, dtype=np.int64)
+    if unassigned is not None:
+        rows = rows[unassigned[rows]]
+    remaining = remaining_capacity.tolist()
     
     # Add student nodes and their preferences
-    for student_id, student_data in priority_students.items():
-        for day, prefs in student_data['days'].items():
-            student_day_node = f"{student_id}_{day}"
-            G.add_edge('source', student_day_node, capacity=1, weight=0)
-            
-            # Add edges for the current preference level
-            activity = prefs[f'{pref_level}_preference']
-            if remaining_capacity[day][activity] > 0:
-                G.add_edge(
-                    student_day_node, 
-                    f"{day}_{activity}", 
-                    capacity=1, 
-                    weight=0
-                )
+    level = PREFERENCE_LEVELS.index(pref_level)
+    for row, day, activity in zip(
+        rows.tolist(), table.day[rows].tolist(), table.choices[rows, level].tolist()
+    ):
+        # Full activities get no edges at all
+        capacity = remaining[day][activity]
+        if capacity <= 0:
+            continue
 
-            # Add sink edges
-            G.add_edge(
-                f"{day}_{activity}", 
-                'sink', 
-                capacity=remaining_capacity[day][activity], 
-                weight=0
-            )
+        student_day_node = index.student_day(row)
+        G.add_edge(SOURCE, student_day_node, capacity=1, weight=0)
+
+        # Add edges for the current preference level
+        activity_node = index.day_activity(day, activity)
+        G.add_edge(
+            student_day_node, 
+            activity_node, 
+            capacity=1, 
+            weight=0
+        )
+
+        # Add sink edges
+        G.add_edge(
+            activity_node, 
+            SINK, 
+            capacity=capacity, 
+            weight=0
+        )
         
     return G
 
-def assign_students_to_activities(G, preferences):
+def solve_priority_rounds(table, backend=DEFAULT_FLOW_BACKEND, check_backend=None, fast_path=True,
+                          instrumentation=None, activity_capacity=None, on_group=None, strict=False):
+    # The nine greedy rounds; returns the activity code assigned to each row
+    # (-1 where none). activity_capacity is the starting capacity per (day
+    # code, activity code) from initial_activity_capacity; it is not modified.
+    # With the fast path (and no cross-check) each round is a bucket fill on
+    # the coded arrays; otherwise each round is solved by the backend.
+    # on_group(label, rows, activities) is called as each priority group
+    # completes, with the rows it assigned and their activity codes.
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    index = NodeIndex(table)
+    assigned = np.full(len(table), -1, dtype=np.int32)
+    if activity_capacity is None:
+        activity_capacity = initial_activity_capacity(table)
+    else:
+        activity_capacity = activity_capacity.copy()
+    unassigned = np.ones(len(table), dtype=bool)
+
+    # Process each priority level
+    for label in PRIORITY_LEVELS:
+        logger.info(f"\nProcessing {label} priority students...")
+        new_rows = assign_priority_group(
+            table, table.rows_with_priority(label), label, activity_capacity, assigned,
+            index, backend, check_backend, fast_path, instrumentation, unassigned, strict
+        )
+        logger.info(f"Assigned {len(np.unique(table.student[new_rows]))} {label} priority students")
+        if on_group is not None:
+            new_rows = np.sort(new_rows)
+            on_group(label, new_rows, assigned[new_rows])
+    return assigned
+
+def emit_groups(table, assigned, on_group):
+    # on_group calls for a finished solve that did not report groups itself
+    for label in PRIORITY_LEVELS:
+        rows = table.rows_with_priority(label)
+        rows = rows[assigned[rows] >= 0]
+        on_group(label, rows, assigned[rows])
+
+def day_partitions(table):
+    # Days never share capacity and every student-day only reaches activities
+    # on its own day, so each day is an independent subproblem
+    partitions = []
+    for day, name in enumerate(table.days):
+        rows = np.flatnonzero(table.day == day)
+        if len(rows):
+            partitions.append((name, rows))
+    return partitions
+
+def _connected_components(num_nodes, u, v):
+    # Min-label propagation with pointer jumping; returns a component label
+    # (the smallest node id in the component) for every node
+    label = np.arange(num_nodes)
+    while True:
+        lowest = np.minimum(label[u], label[v])
+        hooked = label.copy()
+        np.minimum.at(hooked, label[u], lowest)
+        np.minimum.at(hooked, label[v], lowest)
+        while True:
+            jumped = hooked[hooked]
+            if np.array_equal(jumped, hooked):
+                break
+            hooked = jumped
+        if np.array_equal(hooked, label):
+            return label
+        label = hooked
+
+def component_partitions(table):
+    # Splits the student-day/activity graph into connected components: two
+    # (day, activity) pairs are linked when one student-day lists both, so
+    # activities that never share a student are solved separately. Largest
+    # component first.
+    num_activities = max(len(table.activities), 1)
+    nodes = table.day.astype(np.int64)[:, None] * num_activities + table.choices
+    label = _connected_components(
+        max(len(table.days), 1) * num_activities,
+        np.concatenate((nodes[:, 0], nodes[:, 0])),
+        np.concatenate((nodes[:, 1], nodes[:, 2])),
+    )
+    row_label = label[nodes[:, 0]]
+    order = np.argsort(row_label, kind='stable')
+    boundaries = np.flatnonzero(np.diff(row_label[order])) + 1
+    components = np.split(order, boundaries) if len(order) else []
+    components.sort(key=len, reverse=True)
+    return [
+        (f"{table.days[table.day[rows[0]]]} component {number}", rows)
+        for number, rows in enumerate(components, 1)
+    ]
+
+def _batch_partitions(partitions, workers):
+    # Packs partitions into at most workers batches of similar size (largest
+    # first into the lightest batch); rows stay in table order within a batch
+    if len(partitions) <= workers:
+        return partitions
+    batches = [(0, number, [], []) for number in range(workers)]
+    heapq.heapify(batches)
+    for name, rows in sorted(partitions, key=lambda partition: len(partition[1]), reverse=True):
+        size, number, names, row_sets = heapq.heappop(batches)
+        names.append(name)
+        row_sets.append(rows)
+        heapq.heappush(batches, (size + len(rows), number, names, row_sets))
+    return [
+        (f"batch {number + 1} ({len(names)} partitions)", np.sort(np.concatenate(row_sets)))
+        for _, number, names, row_sets in sorted(batches, key=lambda batch: batch[1])
+        if row_sets
+    ]
+
+def _solve_partition(table, backend, check_backend, fast_path, activity_capacity=None, strict=False):
+    # Solves one independent slice of the problem; its progress output is
+    # dropped and its round timings are returned with the result
+    instrumentation = Instrumentation()
+    start_time = time.perf_counter()
+    with muted_progress():
+        assigned = solve_priority_rounds(table, backend, check_backend, fast_path, instrumentation,
+                                         activity_capacity, strict=strict)
+    return assigned, time.perf_counter() - start_time, instrumentation.phases
+
+def assign_students_partitioned(table, partitions, backend=DEFAULT_FLOW_BACKEND, check_backend=None,
+                                fast_path=True, jobs=1, instrumentation=None, activity_capacity=None,
+                                strict=False):
+    # Solves independent partitions (lists of rows) separately and merges the
+    # results; with jobs != 1 they run in a process pool (0 = CPU count).
+    # Partitions share the table's day and activity codes, so every one of
+    # them starts from the same activity_capacity array.
+    if jobs < 0:
+        raise ValueError(f"jobs must not be negative (0 = CPU count), got {jobs}")
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    assigned = np.full(len(table), -1, dtype=np.int32)
+    largest = max((len(rows) for _, rows in partitions), default=0)
+
+    def merge(name, rows, result):
+        part_assigned, seconds, rounds = result
+        assigned[rows] = part_assigned
+        instrumentation.phases.append({
+            'phase': f"partition {name}",
+            'student_days': len(rows),
+            'assigned': int((part_assigned >= 0).sum()),
+            'seconds': seconds,
+            'rounds': rounds,
+        })
+
+    if jobs == 1:
+        logger.info(f"\nSolving {len(partitions)} partitions (largest: {largest} student-days)...")
+        for name, rows in partitions:
+            merge(name, rows, _solve_partition(
+                table.take(rows, solver_only=True), backend, check_backend, fast_path, activity_capacity, strict
+            ))
+        return assigned
+
+    import concurrent.futures
+    workers = jobs or (os.cpu_count() or 1)
+    batches = _batch_partitions(partitions, workers)
+    logger.info(f"\nSolving {len(partitions)} partitions (largest: {largest} student-days) "
+                f"in {len(batches)} processes...")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(len(batches), 1)) as executor:
+        futures = {
+            executor.submit(
+                _solve_partition, table.take(rows, solver_only=True), backend, check_backend, fast_path,
+                activity_capacity, strict
+            ): (name, rows)
+            for name, rows in batches
+        }
+        for future in concurrent.futures.as_completed(futures):
+            name, rows = futures[future]
+            merge(name, rows, future.result())
+            logger.info(f"  {name}: assigned {int((assigned[rows] >= 0).sum())} of {len(rows)} student-days")
+    return assigned
+
+def greedy_assigned(table, backend=DEFAULT_FLOW_BACKEND, check_backend=None, fast_path=True,
+                    instrumentation=None, jobs=1, decompose=False, capacities=None,
+                    max_capacity_per_activity=DEFAULT_CAPACITY, on_group=None, strict=False):
+    # The greedy priority rounds on a PreferenceTable, in one process or
+    # split by day/component; returns the assigned activity code per row.
+    # strict re-raises a failing round instead of logging and skipping it.
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    activity_capacity = initial_activity_capacity(table, max_capacity_per_activity, capacities)
+    if decompose:
+        with instrumentation.phase('decompose') as phase:
+            partitions = component_partitions(table)
+            phase.update(components=len(partitions),
+                         largest=max((len(rows) for _, rows in partitions), default=0))
+        assigned = assign_students_partitioned(
+            table, partitions, backend, check_backend, fast_path, jobs, instrumentation, activity_capacity,
+            strict
+        )
+        if on_group is not None:
+            emit_groups(table, assigned, on_group)
+    elif jobs != 1:
+        assigned = assign_students_partitioned(
+            table, day_partitions(table), backend, check_backend, fast_path, jobs, instrumentation,
+            activity_capacity, strict
+        )
+        if on_group is not None:
+            emit_groups(table, assigned, on_group)
+    else:
+        assigned = solve_priority_rounds(
+            table, backend, check_backend, fast_path, instrumentation, activity_capacity, on_group, strict
+        )
+    return assigned
+
+def assign_students_to_activities(G, preferences, backend=DEFAULT_FLOW_BACKEND, check_backend=None,
+                                  fast_path=True, instrumentation=None, jobs=1, decompose=False,
+                                  capacities=None, max_capacity_per_activity=DEFAULT_CAPACITY, on_group=None):
+    if instrumentation is None:
+        instrumentation = Instrumentation()
     try:
-        # Split students by priority
-        high_priority = {sid: data for sid, data in preferences.items() if data['weight'] == 'high'}
-        medium_priority = {sid: data for sid, data in preferences.items() if data['weight'] == 'medium'}
-        low_priority = {sid: data for sid, data in preferences.items() if data['weight'] == 'low'}
-        
-        assignments = {}
-        activity_capacity = {day: {} for day in DAYS}
-
-        # Initialize activity capacities
-        for day in DAYS:
-            for _, student_data in preferences.items():
-                for activity in student_data['days'][day].values():
-                    if activity not in activity_capacity[day]:
-                        activity_capacity[day][activity] = 15  # max capacity
-
-        # Process each priority level
-        for priority_group, label in [
-            (high_priority, "high"),
-            (medium_priority, "medium"),
-            (low_priority, "low")
-        ]:
-            print(f"\nProcessing {label} priority students...")
-            new_assignments = assign_priority_group(priority_group, label, activity_capacity)
-            print(f"Assigned {len(new_assignments)} {label} priority students")
-            assignments.update(new_assignments)
-
-        if not assignments:
-            print("Warning: No assignments were made")
+        table = as_preference_table(preferences)
+        assigned = greedy_assigned(
+            table, backend, check_backend, fast_path, instrumentation, jobs, decompose,
+            capacities, max_capacity_per_activity, on_group
+        )
+
+        if not (assigned >= 0).any():
+            logger.warning("No assignments were made")
             return None, None
 
         # Calculate preference satisfaction
-        preference_satisfaction = {'1st': 0, '2nd': 0, '3rd': 0, 'other': 0}
-        for student_id, daily_assignments in assignments.items():
-            for day, assigned_activity in daily_assignments.items():
-                student_prefs = preferences[student_id]['days'][day]
-                if assigned_activity == student_prefs['1st_preference']:
-                    preference_satisfaction['1st'] += 1
-                elif assigned_activity == student_prefs['2nd_preference']:
-                    preference_satisfaction['2nd'] += 1
-                elif assigned_activity == student_prefs['3rd_preference']:
-                    preference_satisfaction['3rd'] += 1
-                else:
-                    preference_satisfaction['other'] += 1
+        with instrumentation.phase('satisfaction'):
+            preference_satisfaction = calculate_preference_satisfaction(table, assigned)
 
-        return assignments, preference_satisfaction
+        return table.decode_assignments(assigned), preference_satisfaction
 
     except Exception as e:
-        print(f"Error during flow calculation: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error during flow calculation: {e}")
         return None, None
 
-def print_results(assignments, preferences):
-    if assignments is None:
-        print("No results to print due to earlier errors.")
-        return
-    
-    # First print high priority students' assignments
-    print("\nHigh Priority Student Assignments:")
-    print("=" * 80)
-    print(f"{'Student':^10} | {'Day':^5} | {'Assigned':^20} | {'Was':^10} | {'Preferences':<30}")
-    print("-" * 80)
-    
-    for student_id, daily_activities in sorted(assignments.items()):
-        student_priority = preferences[student_id]['weight']
-        if student_priority != 'high':
+def preference_status(choices, activity):
+    if activity == choices[0]:
+        return '1st'
+    if activity == choices[1]:
+        return '2nd'
+    if activity == choices[2]:
+        return '3rd'
+    return 'other'
+
+SATISFACTION_LEVELS = PREFERENCE_LEVELS + ['other']
+
+def preference_index(choices, activity):
+    # Vectorized preference_status: index into SATISFACTION_LEVELS of each
+    # row's activity among its choices
+    matches = choices == activity[:, None]
+    return np.where(matches.any(axis=1), matches.argmax(axis=1), len(PREFERENCE_LEVELS))
+
+def assignment_stats(table, assigned):
+    # Satisfaction statistics in one pass over the coded arrays: the
+    # preference each assigned row got (index into SATISFACTION_LEVELS), then
+    # bincounts by preference, by priority x preference and by (day,
+    # activity). Returns the overall {level: count}, {priority: {level:
+    # count}} and a days x activities array of participation counts.
+    rows = np.flatnonzero(assigned >= 0)
+    activity = assigned[rows].astype(np.int64)
+    status = preference_index(table.choices[rows], activity)
+
+    num_levels = len(SATISFACTION_LEVELS)
+    by_priority = np.bincount(
+        table.priority[rows].astype(np.int64) * num_levels + status,
+        minlength=len(PRIORITY_LEVELS) * num_levels,
+    ).reshape(len(PRIORITY_LEVELS), num_levels)
+    num_activities = len(table.activities)
+    activity_counts = np.bincount(
+        table.day[rows].astype(np.int64) * num_activities + activity,
+        minlength=len(table.days) * num_activities,
+    ).reshape(len(table.days), num_activities)
+
+    preference_satisfaction = dict(zip(SATISFACTION_LEVELS, by_priority.sum(axis=0).tolist()))
+    priority_satisfaction = {
+        priority: dict(zip(SATISFACTION_LEVELS, counts))
+        for priority, counts in zip(PRIORITY_LEVELS, by_priority.tolist())
+    }
+    return preference_satisfaction, priority_satisfaction, activity_counts
+
+def calculate_preference_satisfaction(table, assigned):
+    preference_satisfaction, _, _ = assignment_stats(table, assigned)
+    return preference_satisfaction
+
+def reassign_students(preferences, assignments, changes, backend=DEFAULT_FLOW_BACKEND, fast_path=True,
+                      max_capacity_per_activity=DEFAULT_CAPACITY, instrumentation=None, capacities=None):
+    # Repairs an existing allocation after late preference changes instead of
+    # re-running every round. changes uses the load_student_preferences layout
+    # (see PreferenceTable.apply_changes). Untouched assignments are kept as
+    # the starting point; changed, added and withdrawn student-days start
+    # unassigned. The nine priority x preference rounds then run over the
+    # residual capacity, but each round only looks at the student-days it can
+    # change: a student-day ranks (priority, preference level, input row) in
+    # a round, as in assign_students_to_activities, and a pending or
+    # worse-placed student-day whose choice for the round still has a slot
+    # among the better-ranked occupants takes it, displacing the worst-ranked
+    # occupant (an augmenting path through that occupant). A displaced
+    # student-day is re-placed in its own later rounds. Kept occupants that no
+    # longer fit a reduced capacity are released the same way, worst-ranked
+    # first. The result is the assignment assign_students_to_activities gives
+    # on the updated table.
+    # Returns the updated table, the new assignments and their satisfaction.
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    try:
+        base = as_preference_table(preferences)
+        with instrumentation.phase('apply changes') as phase:
+            table, source_row, touched = base.apply_changes(changes)
+            phase.update(rows=len(table), changed=int(touched.sum()))
+
+        # Carry over assignments of rows that did not change; anything outside
+        # the row's choices is released
+        previous = base.encode_assignments(assignments) if assignments else np.full(len(base), -1, dtype=np.int32)
+        assigned = np.where(source_row >= 0, previous[source_row], -1).astype(np.int32)
+        assigned[touched] = -1
+        num_levels = len(PREFERENCE_LEVELS)
+        level = preference_index(table.choices, assigned.astype(np.int64))
+        level[assigned < 0] = num_levels
+        assigned[level == num_levels] = -1
+
+        capacity = initial_activity_capacity(table, max_capacity_per_activity, capacities).ravel()
+        num_activities = max(len(table.activities), 1)
+        num_rows = max(len(table), 1)
+        key_space = (len(PRIORITY_LEVELS) * num_levels + 1) * num_rows
+        priority = table.priority.astype(np.int64)
+        day = table.day.astype(np.int64) * num_activities
+        rank_base = priority * num_levels
+
+        def bucket_rank(rows, levels):
+            # Composite (day-activity bucket, priority, level, row) sort key
+            buckets = day[rows] + table.choices[rows, levels]
+            return buckets, buckets * key_space + (rank_base[rows] + levels) * num_rows + rows
+
+        index = NodeIndex(table)
+        repaired = displaced = 0
+        for round_priority, label in enumerate(PRIORITY_LEVELS):
+            for round_level, pref_level in enumerate(PREFERENCE_LEVELS):
+                with instrumentation.phase(f"repair {label}/{pref_level}") as phase:
+                    # Current occupants, sorted by bucket and rank
+                    occupants = np.flatnonzero(assigned >= 0)
+                    _, occupant_ranks = bucket_rank(occupants, level[occupants])
+                    occupant_ranks.sort()
+
+                    def better_ranked(buckets, ranks):
+                        # Occupants of each bucket that rank before ranks
+                        first = np.searchsorted(occupant_ranks, buckets * key_space)
+                        return np.searchsorted(occupant_ranks, ranks) - first
+
+                    group = np.flatnonzero(table.priority == round_priority)
+                    group = group[level[group] >= round_level]
+                    buckets, ranks = bucket_rank(group, np.full(len(group), round_level))
+                    fits = better_ranked(buckets, ranks) < capacity[buckets]
+
+                    # Occupants of this round that no longer fit are released;
+                    # pending or worse-placed rows that fit are candidates
+                    holding = level[group] == round_level
+                    released = group[holding & ~fits]
+                    assigned[released] = -1
+                    level[released] = num_levels
+                    candidates = group[~holding & fits]
+                    if not len(candidates):
+                        phase.update(candidates=0, assigned=0, displaced=len(released))
+                        displaced += len(released)
+                        continue
+
+                    # Contested buckets: the round's places are what the
+                    # better-ranked rounds left; their occupants of this round
+                    # compete with the candidates in input order
+                    contested = np.unique(buckets[~holding & fits])
+                    participants = group[(holding & fits) & np.isin(buckets, contested)]
+                    participants = np.union1d(participants, candidates)
+                    round_rank = contested * key_space + (round_priority * num_levels + round_level) * num_rows
+                    available = np.zeros(len(capacity), dtype=np.int64)
+                    available[contested] = capacity[contested] - better_ranked(contested, round_rank)
+                    network = create_priority_network(
+                        table, participants, available.reshape(-1, num_activities), pref_level, index
+                    )
+                    _, edge_flow = solve_max_flow(network, backend, None, fast_path)
+                    winners, _ = network.decode_flow(edge_flow)
+                    won = np.zeros(len(table), dtype=bool)
+                    won[winners] = True
+
+                    # Winners move in (leaving their old slots); occupants of
+                    # this round that lost are displaced
+                    moved = candidates[won[candidates]]
+                    bumped = participants[(level[participants] == round_level) & ~won[participants]]
+                    assigned[moved] = table.choices[moved, round_level]
+                    level[moved] = round_level
+                    assigned[bumped] = -1
+                    level[bumped] = num_levels
+                    repaired += len(moved)
+                    displaced += len(bumped) + len(released)
+                    phase.update(candidates=len(candidates), assigned=len(moved),
+                                 displaced=len(bumped) + len(released))
+
+        logger.info(f"Repaired {repaired} student-days ({displaced} displaced student-days)")
+
+        with instrumentation.phase('satisfaction'):
+            preference_satisfaction = calculate_preference_satisfaction(table, assigned)
+
+        return table, table.decode_assignments(assigned), preference_satisfaction
+
+    except Exception as e:
+        logger.exception(f"Error during reassignment: {e}")
+        return None, None, None
+
+def build_flow_network_timed(preferences, instrumentation, capacities=None,
+                             max_capacity_per_activity=DEFAULT_CAPACITY):
+    with instrumentation.phase('build flow network') as phase:
+        G = build_flow_network(preferences, None, max_capacity_per_activity, capacities)
+        phase.update(nodes=G.num_nodes, edges=G.num_edges)
+    return G
+
+def global_assigned(G, backend=DEFAULT_FLOW_BACKEND, instrumentation=None, on_group=None):
+    # One min-cost max-flow over the weighted network; returns the assigned
+    # activity code per row of the network's table
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    table = G.index.table
+    logger.info(f"\nSolving global min-cost flow with {backend}...")
+    with instrumentation.phase('global min-cost flow', nodes=G.num_nodes, edges=G.num_edges) as phase:
+        flow_value, edge_flow = MIN_COST_FLOW_BACKENDS[backend](G)
+        total_cost = flow_cost(G, edge_flow)
+        phase.update(flow=flow_value, cost=total_cost)
+    logger.info(f"Global flow: {flow_value} assignments, total cost {total_cost}")
+
+    assigned = np.full(len(table), -1, dtype=np.int32)
+    rows, activities = G.decode_flow(edge_flow)
+    assigned[rows] = activities
+    if on_group is not None:
+        emit_groups(table, assigned, on_group)
+    return assigned
+
+def assign_students_globally(G, preferences, backend=DEFAULT_FLOW_BACKEND, instrumentation=None,
+                             capacities=None, max_capacity_per_activity=DEFAULT_CAPACITY, on_group=None):
+    # One min-cost max-flow over the weighted network from build_flow_network,
+    # instead of nine greedy max-flow rounds
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    try:
+        if G is None:
+            G = build_flow_network_timed(preferences, instrumentation, capacities, max_capacity_per_activity)
+        table = G.index.table
+        assigned = global_assigned(G, backend, instrumentation, on_group)
+
+        if not (assigned >= 0).any():
+            logger.warning("No assignments were made")
+            return None, None
+
+        with instrumentation.phase('satisfaction'):
+            preference_satisfaction = calculate_preference_satisfaction(table, assigned)
+
+        return table.decode_assignments(assigned), preference_satisfaction
+
+    except Exception as e:
+        logger.exception(f"Error during global flow calculation: {e}")
+        return None, None
+
+def print_mode_comparison(results):
+    print("\nSolver Mode Comparison:")
+    print("=" * 96)
+    print(f"{'Mode':^10} | {'Time (s)':^10} | {'Assigned':^10} | {'1st':^14} | {'2nd':^14} | {'3rd':^14} | {'other':^8}")
+    print("-" * 96)
+    for mode, elapsed, preference_satisfaction in results:
+        if preference_satisfaction is None:
+            print(f"{mode:^10} | {elapsed:^10.3f} | {'failed':^10} |")
             continue
-            
-        for day, assigned_activity in sorted(daily_activities.items()):
-            student_prefs = preferences[student_id]['days'][day]
-            pref_status = "other"
-            if assigned_activity == student_prefs['1st_preference']:
-                pref_status = "1st"
-            elif assigned_activity == student_prefs['2nd_preference']:
-                pref_status = "2nd"
-            elif assigned_activity == student_prefs['3rd_preference']:
-                pref_status = "3rd"
-                
-            prefs_str = f"1:{student_prefs['1st_preference']}, 2:{student_prefs['2nd_preference']}, 3:{student_prefs['3rd_preference']}"
-            print(f"{student_id:^10} | {day:^5} | {assigned_activity:^20} | {pref_status:^10} | {prefs_str:<30}")
-
-    # Then print the summary statistics
-    activity_count = {day: {} for day in DAYS}
-    preference_satisfaction = {'1st': 0, '2nd': 0, '3rd': 0, 'other': 0}
-    priority_satisfaction = {priority: {'1st': 0, '2nd': 0, '3rd': 0, 'other': 0} 
-                           for priority in STUDENT_WEIGHTS.keys()}
-    total_assignments = 0
-    
-    for student, daily_activities in assignments.items():
-        student_priority = preferences[student]['weight']
-        for day, assigned_activity in daily_activities.items():
-            total_assignments += 1
-
-            student_prefs = preferences[student]['days'][day]
-            if assigned_activity == student_prefs['1st_preference']:
-                preference_satisfaction['1st'] += 1
-                priority_satisfaction[student_priority]['1st'] += 1
-            elif assigned_activity == student_prefs['2nd_preference']:
-                preference_satisfaction['2nd'] += 1
-                priority_satisfaction[student_priority]['2nd'] += 1
-            elif assigned_activity == student_prefs['3rd_preference']:
-                preference_satisfaction['3rd'] += 1
-                priority_satisfaction[student_priority]['3rd'] += 1
-            else:
-                preference_satisfaction['other'] += 1
-                priority_satisfaction[student_priority]['other'] += 1
+        total = sum(preference_satisfaction.values())
+        counts = [
+            f"{preference_satisfaction[pref]} ({preference_satisfaction[pref] / total * 100:.1f}%)"
+            for pref in ['1st', '2nd', '3rd']
+        ]
+        print(f"{mode:^10} | {elapsed:^10.3f} | {total:^10} | {counts[0]:^14} | {counts[1]:^14} | "
+              f"{counts[2]:^14} | {preference_satisfaction['other']:^8}")
 
-            if assigned_activity not in activity_count[day]:
-                activity_count[day][assigned_activity] = 0
-            activity_count[day][assigned_activity] += 1
+def solve_assignments(G, preferences, mode='greedy', backend=DEFAULT_FLOW_BACKEND,
+                      check_backend=None, fast_path=True, instrumentation=None, jobs=1, decompose=False,
+                      capacities=None, max_capacity_per_activity=DEFAULT_CAPACITY, on_group=None):
+    if mode == 'global':
+        return assign_students_globally(
+            G, preferences, backend, instrumentation, capacities, max_capacity_per_activity, on_group
+        )
+    return assign_students_to_activities(
+        G, preferences, backend, check_backend, fast_path, instrumentation, jobs, decompose,
+        capacities, max_capacity_per_activity, on_group
+    )
 
-    # Print Activity Participation Counts in a table format
-    print("\nActivity Participation Counts:")
-    print("=" * 80)
-    print(f"{'Day':^10} | {'Activity':^30} | {'Count':^10}")
-    print("-" * 80)
-    for day in DAYS:
-        for activity, count in sorted(activity_count[day].items()):
-            print(f"{day.capitalize():^10} | {activity:<30} | {count:^10}")
+def student_sort_key(student_id):
+    # Numeric ids sort by value (9 before 10), any other id as text after them
+    if student_id.isdigit():
+        return (0, int(student_id), '')
+    return (1, 0, student_id)
+
+REPORT_LEVELS = ['summary', 'high', 'full']
+DEFAULT_REPORT_LEVEL = 'high'
+
+# Row templates for the report tables
+ASSIGNMENT_HEADER = f"{'Student':^10} | {'Day':^5} | {'Assigned':^20} | {'Was':^10} | {'Preferences':<30}"
+ASSIGNMENT_ROW = "{:^10} | {:^5} | {:^20} | {:^10} | {:<30}"
+PREFERENCES_CELL = "1:{}, 2:{}, 3:{}"
+PARTICIPATION_HEADER = f"{'Day':^10} | {'Activity':^30} | {'Count':^10}"
+PARTICIPATION_ROW = "{:^10} | {:<30} | {:^10}"
+
+class ReportWriter:
+    # Collects report lines in memory and writes them to the stream in large
+    # chunks instead of one write per line
+    def __init__(self, stream=None, chunk_size=1 << 20):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self._lines = []
+        self._size = 0
+
+    def write_lines(self, lines):
+        for line in lines:
+            self._lines.append(line)
+            self._size += len(line) + 1
+            if self._size >= self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        if self._lines:
+            stream = self.stream if self.stream is not None else sys.stdout
+            stream.write('\n'.join(self._lines) + '\n')
+            self._lines = []
+            self._size = 0
+        if self.stream is not None:
+            self.stream.flush()
 
-    print("\nOverall Preference Satisfaction:")
+def _assignment_lines(table, assigned, priority):
+    # One row per assigned student-day of the given priority, by student then day
+    student_ids = table.student_ids
+    days = table.days
+    activities = table.activities
+    yield f"\n{priority.capitalize()} Priority Student Assignments:"
+    yield "=" * 80
+    yield ASSIGNMENT_HEADER
+    yield "-" * 80
+    rows = np.flatnonzero((assigned >= 0) & (table.priority == PRIORITY_LEVELS.index(priority)))
+    students = table.student[rows].tolist()
+    row_days = table.day[rows].tolist()
+    order = sorted(
+        range(len(rows)),
+        key=lambda position: (student_sort_key(student_ids[students[position]]), days[row_days[position]], position)
+    )
+    choices = table.choices[rows].tolist()
+    activity = assigned[rows].tolist()
+    for position in order:
+        first, second, third = choices[position]
+        yield ASSIGNMENT_ROW.format(
+            student_ids[students[position]], days[row_days[position]], activities[activity[position]],
+            preference_status(choices[position], activity[position]),
+            PREFERENCES_CELL.format(activities[first], activities[second], activities[third]),
+        )
+
+def _summary_lines(table, assigned):
+    days = table.days
+    activities = table.activities
+    preference_satisfaction, priority_satisfaction, activity_counts = assignment_stats(table, assigned)
+    total_assignments = sum(preference_satisfaction.values())
+
+    # Activity Participation Counts in a table format
+    yield "\nActivity Participation Counts:"
+    yield "=" * 80
+    yield PARTICIPATION_HEADER
+    yield "-" * 80
+    for day, counts in zip(days, activity_counts.tolist()):
+        for activity, count in sorted(
+            (activities[activity], count) for activity, count in enumerate(counts) if count
+        ):
+            yield PARTICIPATION_ROW.format(day.capitalize(), activity, count)
+
+    yield "\nOverall Preference Satisfaction:"
     for pref, count in preference_satisfaction.items():
         percentage = (count / total_assignments) * 100
-        print(f"{pref} preference: {count} assignments ({percentage:.2f}%)")
-    print(f"Total assignments: {total_assignments}")
+        yield f"{pref} preference: {count} assignments ({percentage:.2f}%)"
+    yield f"Total assignments: {total_assignments}"
 
-    print("\nPreference Satisfaction by Priority:")
+    yield "\nPreference Satisfaction by Priority:"
     for priority in STUDENT_WEIGHTS.keys():
-        print(f"\n{priority.capitalize()} Priority Students:")
+        yield f"\n{priority.capitalize()} Priority Students:"
         priority_total = sum(priority_satisfaction[priority].values())
         if priority_total > 0:
             for pref, count in priority_satisfaction[priority].items():
                 percentage = (count / priority_total) * 100
-                print(f"  {pref} preference: {count} assignments ({percentage:.2f}%)")
-
-    # Print unassigned students and their preferences
-    unassigned_students = set(preferences.keys()) - set(assignments.keys())
-    if unassigned_students:
-        print("\nUnassigned Students:")
-        for student_id in unassigned_students:
-            print(f"\nStudent {student_id} was not assigned:")
-            print(f"Priority: {preferences[student_id]['weight']}")
-            print("Their preferences were:")
-            for day, prefs in preferences[student_id]['days'].items():
-                print(f"{day}: 1st={prefs['1st_preference']}, 2nd={prefs['2nd_preference']}, 3rd={prefs['3rd_preference']}")
-
-def run(csv_file):
-    preferences = load_student_preferences(csv_file)
+                yield f"  {pref} preference: {count} assignments ({percentage:.2f}%)"
+
+def _unassigned_students(table, assigned):
+    rows = np.flatnonzero(assigned >= 0)
+    assigned_per_student = np.bincount(table.student[rows], minlength=table.num_students)
+    # Only students that still have rows can be unassigned
+    rows_per_student = np.bincount(table.student, minlength=table.num_students)
+    return np.flatnonzero((assigned_per_student == 0) & (rows_per_student > 0))
+
+def _unassigned_lines(table, unassigned_students):
+    days = table.days
+    activities = table.activities
+    yield "\nUnassigned Students:"
+    student_priority = table.student_priority()
+    # Each student's rows are contiguous; find all the slices at once
+    starts = np.searchsorted(table.student, unassigned_students, side='left').tolist()
+    stops = np.searchsorted(table.student, unassigned_students, side='right').tolist()
+    for student, start, stop in zip(unassigned_students.tolist(), starts, stops):
+        yield f"\nStudent {table.student_ids[student]} was not assigned:"
+        yield f"Priority: {PRIORITY_LEVELS[student_priority[student]]}"
+        yield "Their preferences were:"
+        rows = slice(start, stop)
+        for day, (first, second, third) in zip(table.day[rows].tolist(), table.choices[rows].tolist()):
+            yield f"{days[day]}: 1st={activities[first]}, 2nd={activities[second]}, 3rd={activities[third]}"
+
+def report_lines(table, assigned, level=DEFAULT_REPORT_LEVEL):
+    # summary: participation and satisfaction tables plus the number of
+    # unassigned students; high: also the high priority assignments and each
+    # unassigned student's preferences; full: also every medium and low
+    # priority assignment
+    if level not in REPORT_LEVELS:
+        raise ValueError(f"Unknown report level {level!r}")
+    if level != 'summary':
+        yield from _assignment_lines(table, assigned, 'high')
+    if level == 'full':
+        for priority in PRIORITY_LEVELS[1:]:
+            yield from _assignment_lines(table, assigned, priority)
+    yield from _summary_lines(table, assigned)
+
+    unassigned_students = _unassigned_students(table, assigned)
+    if level == 'summary':
+        yield f"\nUnassigned students: {len(unassigned_students)}"
+    elif len(unassigned_students):
+        yield from _unassigned_lines(table, unassigned_students)
+
+def print_results(assignments, preferences, level=DEFAULT_REPORT_LEVEL, output=None):
+    # Renders the report through a ReportWriter to output (default stdout)
+    if assignments is None:
+        print("No results to print due to earlier errors.")
+        return
+
+    table = as_preference_table(preferences)
+    assigned = table.encode_assignments(assignments)
+    writer = ReportWriter(output)
+    writer.write_lines(report_lines(table, assigned, level))
+    writer.flush()
+
+EXPORT_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.npz': 'npz'}
+EXPORT_FIELDS = ['student_id', 'day', 'activity', 'preference', 'priority']
+
+class AssignmentExporter(abc.ABC):
+    # Writes assignments to a file as each priority group completes: one
+    # record per assigned student-day with the EXPORT_FIELDS. Use it as the
+    # solver's on_group callback and close it when the run is over.
+    def __init__(self, path, table):
+        self.path = path
+        self.table = table
+        self.rows_written = 0
+
+    def __call__(self, label, rows, activities):
+        rows = np.asarray(rows, dtype=np.int64)
+        activities = np.asarray(activities, dtype=np.int64)
+        self.write_group(label, rows, activities)
+        self.rows_written += len(rows)
+
+    def records(self, label, rows, activities):
+        table = self.table
+        names = table.activities
+        preference = preference_index(table.choices[rows], activities).tolist()
+        for student, day, activity, status in zip(
+            table.student[rows].tolist(), table.day[rows].tolist(), activities.tolist(), preference
+        ):
+            yield (table.student_ids[student], table.days[day], names[activity], SATISFACTION_LEVELS[status], label)
+
+    @abc.abstractmethod
+    def write_group(self, label, rows, activities):
+        pass
+
+    def close(self):
+        pass
+
+class CsvAssignmentExporter(AssignmentExporter):
+    def __init__(self, path, table):
+        super().__init__(path, table)
+        self.file = open(path, mode='w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(EXPORT_FIELDS)
+
+    def write_group(self, label, rows, activities):
+        self.writer.writerows(self.records(label, rows, activities))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class JsonLinesAssignmentExporter(AssignmentExporter):
+    def __init__(self, path, table):
+        super().__init__(path, table)
+        self.file = open(path, mode='w')
+
+    def write_group(self, label, rows, activities):
+        self.file.write(''.join(
+            json.dumps(dict(zip(EXPORT_FIELDS, record))) + '\n'
+            for record in self.records(label, rows, activities)
+        ))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ColumnarAssignmentExporter(AssignmentExporter):
+    # An uncompressed .npz that np.load can read: the string tables
+    # (student_ids, days, activities, preferences) first, then one set of
+    # coded columns per priority group as it completes, e.g. high_student,
+    # high_day, high_activity (codes into the string tables) and
+    # high_preference (index into preferences)
+    def __init__(self, path, table):
+        super().__init__(path, table)
+        self.archive = zipfile.ZipFile(path, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True)
+        self._write_member('student_ids', np.array(list(table.student_ids), dtype=str))
+        self._write_member('days', np.array(table.days, dtype=str))
+        self._write_member('activities', np.array(table.activities, dtype=str))
+        self._write_member('preferences', np.array(SATISFACTION_LEVELS, dtype=str))
+
+    def _write_member(self, name, values):
+        with self.archive.open(f"{name}.npy", mode='w', force_zip64=True) as member:
+            np.lib.format.write_array(member, np.ascontiguousarray(values), allow_pickle=False)
+
+    def write_group(self, label, rows, activities):
+        table = self.table
+        self._write_member(f"{label}_student", table.student[rows])
+        self._write_member(f"{label}_day", table.day[rows])
+        self._write_member(f"{label}_activity", activities.astype(np.int32))
+        self._write_member(f"{label}_preference", preference_index(table.choices[rows], activities).astype(np.int8))
+
+    def close(self):
+        self.archive.close()
+
+ASSIGNMENT_EXPORTERS = {
+    'csv': CsvAssignmentExporter,
+    'jsonl': JsonLinesAssignmentExporter,
+    'npz': ColumnarAssignmentExporter,
+}
+
+def open_assignment_exporter(path, table):
+    # Format from the file extension: .csv, .jsonl or .npz
+    export_format = EXPORT_FORMATS.get(os.path.splitext(path)[1].lower())
+    if export_format is None:
+        raise ValueError(f"Unknown export format for {path}; use one of {', '.join(EXPORT_FORMATS)}")
+    return ASSIGNMENT_EXPORTERS[export_format](path, table)
+
+class AllocationResult:
+    # What allocate() returns. assignments is {student_id: {day: activity}};
+    # satisfaction is {level: count} overall and priority_satisfaction the
+    # same per priority; participation is {day: {activity: count}};
+    # unassigned_students lists the students who got no activity on any day
+    # and unassigned_days every (student_id, day) left without one; timings
+    # holds the Instrumentation phase records. table and assigned are the
+    # coded form the other fields were decoded from.
+    __slots__ = ('table', 'assigned', 'assignments', 'satisfaction', 'priority_satisfaction',
+                 'participation', 'unassigned_students', 'unassigned_days', 'timings')
+
+    def __init__(self, table, assigned, timings=()):
+        self.table = table
+        self.assigned = assigned
+        self.assignments = table.decode_assignments(assigned)
+        self.satisfaction, self.priority_satisfaction, activity_counts = assignment_stats(table, assigned)
+        self.participation = {
+            day: {table.activities[activity]: count for activity, count in enumerate(counts) if count}
+            for day, counts in zip(table.days, activity_counts.tolist())
+        }
+        self.unassigned_students = [
+            table.student_ids[student] for student in _unassigned_students(table, assigned).tolist()
+        ]
+        rows = np.flatnonzero(assigned < 0)
+        self.unassigned_days = [
+            (table.student_ids[student], table.days[day])
+            for student, day in zip(table.student[rows].tolist(), table.day[rows].tolist())
+        ]
+        self.timings = list(timings)
+
+    @property
+    def assigned_count(self):
+        return sum(self.satisfaction.values())
+
+    def to_dict(self):
+        # Plain JSON-serializable form
+        return {
+            'assignments': self.assignments,
+            'satisfaction': self.satisfaction,
+            'priority_satisfaction': self.priority_satisfaction,
+            'participation': self.participation,
+            'unassigned_students': self.unassigned_students,
+            'unassigned_days': [list(pair) for pair in self.unassigned_days],
+            'timings': self.timings,
+        }
+
+    def __repr__(self):
+        return (f"AllocationResult(assigned={self.assigned_count}, rows={len(self.table)}, "
+                f"unassigned_students={len(self.unassigned_students)})")
+
+def allocate(preferences, capacities=None, mode='greedy', backend=DEFAULT_FLOW_BACKEND, check_backend=None,
+             fast_path=True, jobs=1, decompose=False, max_capacity_per_activity=DEFAULT_CAPACITY,
+             on_group=None, instrumentation=None):
+    # In-process entry point: solves one allocation and returns an
+    # AllocationResult without printing anything (progress goes to the
+    # logger). preferences is a PreferenceTable, a {student_id: Student}
+    # mapping or the legacy nested dict; capacities is {(day, activity):
+    # capacity} as from load_activity_capacities. The other options match
+    # run() and the CLI flags. Errors are raised, not logged: bad options up
+    # front, and a failing round (including a --check-backend mismatch)
+    # instead of being skipped.
+    if mode not in ('greedy', 'global'):
+        raise ValueError(f"Unknown allocation mode {mode!r}; expected 'greedy' or 'global'")
+    if backend not in FLOW_BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}; expected one of {sorted(FLOW_BACKENDS)}")
+    if check_backend is not None and check_backend not in FLOW_BACKENDS:
+        raise ValueError(f"Unknown check_backend {check_backend!r}; expected one of {sorted(FLOW_BACKENDS)}")
+    if not isinstance(jobs, (int, np.integer)) or jobs < 0:
+        raise ValueError(f"jobs must be a non-negative integer (0 = CPU count), not {jobs!r}")
+    if not isinstance(max_capacity_per_activity, (int, np.integer)) or max_capacity_per_activity < 0:
+        raise ValueError(f"max_capacity_per_activity must be a non-negative integer, "
+                         f"not {max_capacity_per_activity!r}")
+    for key, value in (capacities or {}).items():
+        if not isinstance(value, (int, np.integer)) or value < 0:
+            raise ValueError(f"Capacity for {key!r} must be a non-negative integer, not {value!r}")
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+
+    table = as_preference_table(preferences)
+    if not len(table):
+        raise ValueError("No preferences to allocate")
+    if mode == 'global':
+        G = build_flow_network_timed(table, instrumentation, capacities, max_capacity_per_activity)
+        assigned = global_assigned(G, backend, instrumentation, on_group)
+    else:
+        assigned = greedy_assigned(
+            table, backend, check_backend, fast_path, instrumentation, jobs, decompose,
+            capacities, max_capacity_per_activity, on_group, strict=True
+        )
+    with instrumentation.phase('satisfaction'):
+        result = AllocationResult(table, assigned)
+    result.timings = list(instrumentation.phases)
+    return result
+
+def run(csv_file, backend=DEFAULT_FLOW_BACKEND, check_backend=None, fast_path=True, mode='greedy',
+        instrumentation=None, jobs=1, decompose=False, capacities_file=None,
+        max_capacity_per_activity=DEFAULT_CAPACITY, cache_dir=None, mmap=False,
+        report_level=DEFAULT_REPORT_LEVEL, report_file=None, export_files=()):
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+
+    with instrumentation.phase('load') as phase:
+        if cache_dir:
+            preferences = load_preferences_cached(csv_file, cache_dir, mmap)
+        else:
+            preferences = load_preference_table(csv_file)
+        if preferences:
+            phase.update(rows=len(preferences), students=preferences.num_students)
     if not preferences:
-        print("No preferences loaded. Exiting.")
+        logger.error("No preferences loaded. Exiting.")
         return
 
+    capacities = None
+    if capacities_file:
+        with instrumentation.phase('load capacities') as phase:
+            capacities = load_activity_capacities(capacities_file)
+            if capacities is not None:
+                phase.update(activities=len(capacities))
+        if capacities is None:
+            logger.error("No capacities loaded. Exiting.")
+            return
+
     # Debug print to verify priorities
-    priority_counts = {'high': 0, 'medium': 0, 'low': 0}
-    for student_data in preferences.values():
-        priority_counts[student_data['weight']] += 1
-    print("\nStudent priority distribution:")
-    for priority, count in priority_counts.items():
-        print(f"{priority}: {count} students")
-
-    G = build_flow_network(preferences, DAYS)
-    assignments, preference_satisfaction = assign_students_to_activities(G, preferences)
+    priority_counts = np.bincount(preferences.student_priority(), minlength=len(PRIORITY_LEVELS))
+    logger.info("\nStudent priority distribution:")
+    for priority, count in zip(PRIORITY_LEVELS, priority_counts.tolist()):
+        logger.info(f"{priority}: {count} students")
+
+    # The weighted network is only built for modes that solve on it
+    G = None
+    if mode in GRAPH_MODES:
+        G = build_flow_network_timed(preferences, instrumentation, capacities, max_capacity_per_activity)
+
+    if mode == 'compare':
+        results = []
+        for solver_mode in ['greedy', 'global']:
+            with instrumentation.phase(f"solve ({solver_mode})") as phase:
+                _, preference_satisfaction = solve_assignments(
+                    G, preferences, solver_mode, backend, check_backend, fast_path, instrumentation, jobs, decompose,
+                    capacities, max_capacity_per_activity
+                )
+            results.append((solver_mode, phase['seconds'], preference_satisfaction))
+        if report_level is not None:
+            with instrumentation.phase('report'):
+                print_mode_comparison(results)
+        if export_files:
+            logger.warning("Exports are not written in compare mode.")
+        return
+
+    # Exporters receive each priority group as soon as it is assigned
+    exporters = []
+    try:
+        for export_file in export_files:
+            exporters.append(open_assignment_exporter(export_file, preferences))
+    except Exception as e:
+        logger.error(f"Error opening export file: {e}")
+        for exporter in exporters:
+            exporter.close()
+        return
+
+    def export_group(label, rows, activities):
+        for exporter in exporters:
+            exporter(label, rows, activities)
+
+    try:
+        with instrumentation.phase(f"solve ({mode})"):
+            assignments, preference_satisfaction = solve_assignments(
+                G, preferences, mode, backend, check_backend, fast_path, instrumentation, jobs, decompose,
+                capacities, max_capacity_per_activity, export_group if exporters else None
+            )
+    finally:
+        for exporter in exporters:
+            exporter.close()
+            logger.info(f"Exported {exporter.rows_written} assignments to {exporter.path}")
     
     if assignments:
-        print("\nAssignments completed successfully.")
-        print_results(assignments, preferences)
+        logger.info("\nAssignments completed successfully.")
+        # A report level of None leaves reporting to the caller
+        if report_level is not None:
+            with instrumentation.phase('report', level=report_level):
+                if report_file:
+                    with open(report_file, mode='w') as output:
+                        print_results(assignments, preferences, report_level, output)
+                    logger.info(f"Report written to {report_file}")
+                else:
+                    print_results(assignments, preferences, report_level)
         
         # Debug print for assignment counts
         assigned_count = len(assignments)
-        print(f"\nTotal students assigned: {assigned_count}")
-        print(f"Total students in system: {len(preferences)}")
+        logger.info(f"\nTotal students assigned: {assigned_count}")
+        logger.info(f"Total students in system: {preferences.num_students}")
     else:
-        print("Error: No assignments were made.")
+        logger.error("No assignments were made.")
+    return assignments, preference_satisfaction
 
 def main():
     import argparse
-    import time
 
     parser = argparse.ArgumentParser(description='Activity Assignment Algorithm')
     parser.add_argument('csv_file', nargs='?', default='student_preferences.csv',
                        help='Path to the CSV file containing student preferences')
+    parser.add_argument('--backend', choices=sorted(FLOW_BACKENDS), default=DEFAULT_FLOW_BACKEND,
+                       help='Max-flow engine used for the priority rounds')
+    parser.add_argument('--check-backend', choices=sorted(FLOW_BACKENDS), default=None,
+                       help='Cross-check every round\'s flow value against this backend')
+    parser.add_argument('--no-fast-path', dest='fast_path', action='store_false',
+                       help='Always use the max-flow backend, even for single-choice rounds')
+    parser.add_argument('--mode', choices=SOLVER_MODES, default='greedy',
+                       help='greedy priority rounds, one global min-cost flow, or compare both')
+    parser.add_argument('--jobs', type=int, default=1,
+                       help='Solve the greedy rounds for each day (or component, with --decompose) in '
+                            'parallel with this many processes (0 = CPU count)')
+    parser.add_argument('--decompose', action='store_true',
+                       help='Split each day into connected components of activities that share students '
+                            'and solve them separately')
+    parser.add_argument('--capacities', default=None,
+                       help='CSV file with day,activity,capacity rows overriding the default capacity')
+    parser.add_argument('--default-capacity', type=int, default=DEFAULT_CAPACITY,
+                       help='Places per activity per day for activities not in the capacities file')
+    parser.add_argument('--cache-dir', default=None,
+                       help='Keep a binary snapshot of the parsed CSV in this directory and reuse it '
+                            'while the CSV is unchanged')
+    parser.add_argument('--mmap', action='store_true',
+                       help='With --cache-dir, memory-map the snapshot instead of reading it into memory')
+    parser.add_argument('--report-level', choices=REPORT_LEVELS, default=DEFAULT_REPORT_LEVEL,
+                       help='summary: statistics only; high: also high priority assignments and unassigned '
+                            'students; full: also every medium and low priority assignment')
+    parser.add_argument('--report-file', default=None,
+                       help='Write the assignment report to this file instead of stdout')
+    parser.add_argument('--export', action='append', default=[], metavar='PATH',
+                       help='Write the assignments to PATH as each priority group completes; the format '
+                            'follows the extension (.csv, .jsonl or columnar .npz). May be repeated.')
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='info',
+                       help='Lowest level of progress message to print')
+    parser.add_argument('--quiet', dest='log_level', action='store_const', const='warning',
+                       help='Only print warnings and errors besides the report (same as --log-level warning)')
+    parser.add_argument('--timings', action='store_true',
+                       help='Print per-phase timings, network sizes and flow values')
+    parser.add_argument('--report-json', default=None,
+                       help='Write the per-phase report as JSON to this path')
+    parser.add_argument('--profile', default=None,
+                       help='Run under cProfile and write pstats data to this path')
     
     args = parser.parse_args()
+    if args.mmap and not args.cache_dir:
+        parser.error('--mmap needs --cache-dir')
+    if args.export and args.mode == 'compare':
+        parser.error('--export cannot be used with --mode compare')
+    if args.jobs < 0:
+        parser.error('--jobs must not be negative (0 = CPU count)')
+    if args.default_capacity < 0:
+        parser.error('--default-capacity must not be negative')
+    configure_logging(args.log_level)
     
+    instrumentation = Instrumentation()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     start_time = time.time()
-    run(args.csv_file)
+    run(args.csv_file, args.backend, args.check_backend, args.fast_path, args.mode, instrumentation,
+        args.jobs, args.decompose, args.capacities, args.default_capacity, args.cache_dir,
+        args.mmap, args.report_level, args.report_file, args.export)
     end_time = time.time()
-    print(f"\nTime taken: {end_time - start_time} seconds")
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        logger.info(f"\nProfile written to {args.profile} (view with: python3 -m pstats {args.profile})")
+    if args.timings:
+        print_phase_timings(instrumentation)
+    if args.report_json:
+        instrumentation.write_json(args.report_json, total_seconds=end_time - start_time)
+    logger.info(f"\nTime taken: {end_time - start_time} seconds")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,377 @@
+###
+### Benchmarks for the Activity Assignment Algorithm (AAA)
+###
+
+import argparse
+import concurrent.futures
+import contextlib
+import functools
+import io
+import json
+import math
+import multiprocessing
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import auto_assign
+
+SNAPSHOT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'aaa-snapshots')
+
+def load_snapshot(csv_file):
+    # Columnar loader behind the snapshot cache; only the first call parses
+    return auto_assign.load_preferences_cached(csv_file, SNAPSHOT_CACHE_DIR)
+
+def load_snapshot_mmap(csv_file):
+    return auto_assign.load_preferences_cached(csv_file, SNAPSHOT_CACHE_DIR, mmap=True)
+
+LOADERS = {
+    'records': auto_assign.load_student_preferences,
+    'columnar': auto_assign.load_preference_table,
+    'snapshot': load_snapshot,
+    'mmap': load_snapshot_mmap,
+}
+
+def peak_rss():
+    # Peak resident set size of this process so far, in bytes. VmHWM is used
+    # where available because ru_maxrss carries over from the parent process
+    # across fork and exec; ru_maxrss is in kilobytes on Linux.
+    try:
+        with open('/proc/self/status', mode='r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _loader_peak_rss(name, csv_file):
+    # Runs in a fresh process: load, read every column once (as the solver
+    # would) and report that process's peak RSS
+    with contextlib.redirect_stdout(io.StringIO()):
+        table = auto_assign.as_preference_table(LOADERS[name](csv_file))
+        int(table.student.sum()) + int(table.day.sum()) + int(table.choices.sum()) + int(table.priority.sum())
+    return peak_rss()
+
+def measure_peak_rss(name, csv_file):
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_loader_peak_rss, name, csv_file).result()
+
+def count_rows(csv_file):
+    with open(csv_file, mode='r') as file:
+        return max(sum(1 for line in file if line.strip()) - 1, 0)
+
+def measure_loader(loader, csv_file, repeat):
+    # Best-of-N wall time, then one traced run for retained and peak memory
+    timings = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start_time = time.perf_counter()
+            loader(csv_file)
+            timings.append(time.perf_counter() - start_time)
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = loader(csv_file)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return min(timings), retained, peak
+
+def compare_loaders(csv_file, repeat):
+    rows = count_rows(csv_file)
+    print(f"Loading {csv_file} ({rows} rows), best of {repeat}:")
+    print("=" * 96)
+    print(f"{'Loader':^10} | {'Time (s)':^10} | {'Rows/s':^12} | {'Retained (MB)':^14} | {'Peak (MB)':^12} | "
+          f"{'Peak RSS (MB)':^14}")
+    print("-" * 96)
+    for name, loader in LOADERS.items():
+        elapsed, retained, peak = measure_loader(loader, csv_file, repeat)
+        rss = measure_peak_rss(name, csv_file)
+        print(f"{name:^10} | {elapsed:^10.4f} | {rows / elapsed:^12.0f} | "
+              f"{retained / 2**20:^14.2f} | {peak / 2**20:^12.2f} | {rss / 2**20:^14.1f}")
+
+# Interpreter start plus import, timed in fresh processes. numpy is the floor:
+# every mode needs it. LAZY_MODULES must not be loaded by a plain import.
+SOURCE_DIR = os.path.dirname(os.path.abspath(auto_assign.__file__))
+STARTUP_COMMANDS = {
+    'python': [sys.executable, '-c', 'pass'],
+    'numpy': [sys.executable, '-c', 'import numpy'],
+    'import auto_assign': [sys.executable, '-c', 'import auto_assign'],
+    'cli --help': [sys.executable, os.path.join(SOURCE_DIR, 'auto_assign.py'), '--help'],
+}
+LAZY_MODULES = ['networkx', 'concurrent.futures']
+
+def measure_startup(command, repeat):
+    # One untimed run first so every timed run finds the bytecode cache warm
+    timings = []
+    for _ in range(repeat + 1):
+        start_time = time.perf_counter()
+        subprocess.run(command, cwd=SOURCE_DIR, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start_time)
+    return timings[1:]
+
+def eagerly_loaded_modules():
+    script = f"import auto_assign, sys; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    output = subprocess.run([sys.executable, '-c', script], cwd=SOURCE_DIR, check=True,
+                            capture_output=True, text=True).stdout.strip()
+    return output.split(',') if output else []
+
+def compare_startup(repeat, max_seconds=None):
+    # Returns False when a lazy module is imported eagerly or the import takes
+    # longer than max_seconds, so CI can fail on a startup regression
+    print(f"Startup time, best and median of {repeat} fresh processes:")
+    print("=" * 60)
+    print(f"{'Command':^20} | {'Best (s)':^10} | {'Median (s)':^10} | {'Import (s)':^10}")
+    print("-" * 60)
+    baseline = None
+    results = {}
+    for name, command in STARTUP_COMMANDS.items():
+        timings = measure_startup(command, repeat)
+        results[name] = best = min(timings)
+        if baseline is None:
+            baseline = best
+        print(f"{name:^20} | {best:^10.4f} | {statistics.median(timings):^10.4f} | {best - baseline:^10.4f}")
+
+    ok = True
+    eager = eagerly_loaded_modules()
+    if eager:
+        print(f"\nImported eagerly by 'import auto_assign': {', '.join(eager)}")
+        ok = False
+    import_seconds = results['import auto_assign'] - baseline
+    if max_seconds is not None and import_seconds > max_seconds:
+        print(f"\nImport took {import_seconds:.4f}s, over the {max_seconds:.4f}s limit")
+        ok = False
+    return ok
+
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_PRIORITY_MIX = 'high=0.02,medium=0.93,low=0.05'
+
+def parse_priority_mix(text):
+    mix = {}
+    for item in text.split(','):
+        priority, share = item.split('=')
+        priority = priority.strip()
+        if priority not in auto_assign.STUDENT_WEIGHTS:
+            raise ValueError(f"Unknown priority {priority!r}")
+        mix[priority] = float(share)
+    total = sum(mix.values())
+    return {priority: share / total for priority, share in mix.items()}
+
+def default_activities(students, capacity):
+    # Enough activity slots per day for every student plus 10% slack
+    return max(3, math.ceil(students * 1.1 / capacity))
+
+def _sample_choices(rng, probabilities, count):
+    # Three distinct activities per row drawn by popularity; duplicates are
+    # redrawn until each row's choices differ
+    choices = rng.choice(len(probabilities), size=(count, 3), p=probabilities)
+    for column in (1, 2):
+        while True:
+            clash = (choices[:, column, None] == choices[:, :column]).any(axis=1)
+            if not clash.any():
+                break
+            choices[clash, column] = rng.choice(len(probabilities), size=int(clash.sum()), p=probabilities)
+    return choices
+
+def generate_cohort(csv_file, students, days=4, activities=None, skew=1.0,
+                    priority_mix=DEFAULT_PRIORITY_MIX, capacity=15, seed=0, chunk_size=50000):
+    # Writes a synthetic preference CSV. Activity popularity follows a Zipf
+    # law with exponent skew (0 means uniform).
+    if activities is None:
+        activities = default_activities(students, capacity)
+    if activities < 3:
+        raise ValueError("At least 3 activities are needed for three distinct preferences")
+    if not 1 <= days <= len(WEEKDAYS):
+        raise ValueError(f"days must be between 1 and {len(WEEKDAYS)}")
+
+    rng = np.random.default_rng(seed)
+    mix = parse_priority_mix(priority_mix)
+    priority_names = list(mix)
+    popularity = 1.0 / np.arange(1, activities + 1) ** skew
+    probabilities = popularity / popularity.sum()
+    activity_names = [f"Activity{code:05d}" for code in rng.permutation(activities)]
+    day_names = WEEKDAYS[:days]
+    width = len(str(students))
+
+    with open(csv_file, mode='w', newline='') as file:
+        file.write('student_id,day,1st_preference,2nd_preference,3rd_preference,priority\n')
+        for start in range(0, students, chunk_size):
+            stop = min(start + chunk_size, students)
+            priorities = rng.choice(len(priority_names), size=stop - start, p=list(mix.values()))
+            choices = _sample_choices(rng, probabilities, (stop - start) * days).tolist()
+            lines = []
+            for offset, student in enumerate(range(start, stop)):
+                student_id = f"S{student:0{width}d}"
+                priority = priority_names[priorities[offset]]
+                for day_offset, day in enumerate(day_names):
+                    first, second, third = choices[offset * days + day_offset]
+                    lines.append(
+                        f"{student_id},{day},{activity_names[first]},{activity_names[second]},"
+                        f"{activity_names[third]},{priority}\n"
+                    )
+            file.write(''.join(lines))
+    return csv_file
+
+def cohort_path(workdir, students, days, activities, skew, priority_mix, capacity, seed):
+    mix = '-'.join(f"{priority}{share:g}" for priority, share in parse_priority_mix(priority_mix).items())
+    name = f"cohort_s{students}_d{days}_a{activities}_k{skew:g}_c{capacity}_{mix}_seed{seed}.csv"
+    return os.path.join(workdir, name)
+
+def timed(records, phase, func, *args, **extra):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_time = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start_time
+    records.append(dict(phase=phase, seconds=elapsed, peak_rss=peak_rss(), **extra))
+    return result
+
+def benchmark_phases(csv_file, capacity, backend, fast_path, loader, with_graph):
+    # Times each stage of run() separately; returns one record per phase
+    records = []
+    table = timed(records, f"load ({loader})", LOADERS[loader], csv_file)
+    table = auto_assign.as_preference_table(table)
+    if with_graph:
+        G = timed(records, 'build_flow_network', auto_assign.build_flow_network,
+                  table, set(table.days), capacity)
+        records[-1].update(nodes=G.num_nodes, edges=G.num_edges)
+        del G
+
+    # The solver's own per-round phase records follow the solve record; they
+    # are marked part_of so the suite total does not count them twice
+    instrumentation = auto_assign.Instrumentation()
+    solve = functools.partial(auto_assign.greedy_assigned, backend=backend, fast_path=fast_path,
+                              instrumentation=instrumentation, max_capacity_per_activity=capacity)
+    assigned = timed(records, 'greedy_assigned', solve, table, rows=len(table))
+    records[-1]['assigned'] = int((assigned >= 0).sum())
+    for phase in instrumentation.phases:
+        records.append(dict(phase, part_of='greedy_assigned'))
+
+    assignments = table.decode_assignments(assigned)
+    timed(records, 'print_results', auto_assign.print_results, assignments, table)
+    return records
+
+def load_baseline(path):
+    baseline = {}
+    with open(path, mode='r') as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                baseline[(record['students'], record['phase'])] = record['seconds']
+    return baseline
+
+def run_suite(args):
+    workdir = args.workdir or tempfile.gettempdir()
+    baseline = load_baseline(args.compare_to) if args.compare_to else {}
+    output = open(args.json, mode='w') if args.json else None
+
+    print(f"{'Students':^10} | {'Phase':^32} | {'Time (s)':^10} | {'vs baseline':^12} | {'Peak RSS (MB)':^14}")
+    print("-" * 91)
+    try:
+        for students in args.sizes:
+            activities = args.activities or default_activities(students, args.capacity)
+            csv_file = cohort_path(workdir, students, args.days, activities, args.skew,
+                                   args.priority_mix, args.capacity, args.seed)
+            if not os.path.exists(csv_file):
+                generate_cohort(csv_file, students, args.days, activities, args.skew,
+                                args.priority_mix, args.capacity, args.seed)
+            rows = count_rows(csv_file)
+
+            records = benchmark_phases(csv_file, args.capacity, args.backend, args.fast_path,
+                                       args.loader, args.with_graph)
+            total = sum(record['seconds'] for record in records if 'part_of' not in record)
+            records.append(dict(phase='total', seconds=total, peak_rss=peak_rss()))
+            for record in records:
+                record.update(
+                    students=students, rows=rows, days=args.days, activities=activities,
+                    skew=args.skew, capacity=args.capacity, backend=args.backend,
+                    fast_path=args.fast_path, seed=args.seed,
+                )
+                previous = baseline.get((students, record['phase']))
+                ratio = f"{record['seconds'] / previous:.2f}x" if previous else '-'
+                rss = f"{record['peak_rss'] / 2**20:.1f}" if 'peak_rss' in record else '-'
+                name = f"  {record['phase']}" if 'part_of' in record else record['phase']
+                print(f"{students:^10} | {name:<32} | {record['seconds']:^10.4f} | {ratio:^12} | {rss:^14}")
+                if output:
+                    output.write(json.dumps(record) + '\n')
+                    output.flush()
+    finally:
+        if output:
+            output.close()
+
+def add_cohort_arguments(parser):
+    parser.add_argument('--days', type=int, default=4, help='Days per student (mon, tue, ...)')
+    parser.add_argument('--activities', type=int, default=None,
+                        help='Activities offered per day (default: enough slots for everyone plus 10%%)')
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='Zipf exponent of activity popularity (0 = uniform)')
+    parser.add_argument('--priority-mix', default=DEFAULT_PRIORITY_MIX,
+                        help='Share of students per priority, e.g. high=0.02,medium=0.93,low=0.05')
+    parser.add_argument('--capacity', type=int, default=15, help='Capacity per activity per day')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+
+def main():
+    parser = argparse.ArgumentParser(description='Activity Assignment Algorithm benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    loaders_parser = subparsers.add_parser('loaders', help='Compare the record, columnar, snapshot and mmap loaders')
+    loaders_parser.add_argument('csv_file', nargs='?', default='student_preferences.csv',
+                                help='Path to the CSV file containing student preferences')
+    loaders_parser.add_argument('--repeat', type=int, default=3,
+                                help='Number of timed runs per loader')
+
+    startup_parser = subparsers.add_parser('startup', help='Time interpreter start plus import of auto_assign')
+    startup_parser.add_argument('--repeat', type=int, default=10,
+                                help='Number of timed processes per command')
+    startup_parser.add_argument('--max-seconds', type=float, default=None,
+                                help='Exit with status 1 if importing auto_assign takes longer than this')
+
+    generate_parser = subparsers.add_parser('generate', help='Write a synthetic preference CSV')
+    generate_parser.add_argument('csv_file', help='Output path')
+    add_cohort_arguments(generate_parser)
+    generate_parser.add_argument('--students', type=int, default=1000, help='Number of students')
+
+    suite_parser = subparsers.add_parser('suite', help='Time each phase across cohort sizes')
+    add_cohort_arguments(suite_parser)
+    suite_parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                              help='Cohort sizes (number of students) to benchmark')
+    suite_parser.add_argument('--backend', choices=sorted(auto_assign.FLOW_BACKENDS),
+                              default=auto_assign.DEFAULT_FLOW_BACKEND, help='Max-flow engine')
+    suite_parser.add_argument('--no-fast-path', dest='fast_path', action='store_false',
+                              help='Always use the max-flow backend')
+    suite_parser.add_argument('--loader', choices=sorted(LOADERS), default='columnar',
+                              help='CSV loader to time')
+    suite_parser.add_argument('--with-graph', action='store_true',
+                              help='Also time build_flow_network, which only the global mode uses')
+    suite_parser.add_argument('--workdir', default=None,
+                              help='Directory for generated cohorts (reused between runs)')
+    suite_parser.add_argument('--json', default=None,
+                              help='Write one JSON record per size and phase to this file')
+    suite_parser.add_argument('--compare-to', default=None,
+                              help='Earlier --json output; prints each phase\'s time ratio against it')
+
+    args = parser.parse_args()
+    if args.command == 'loaders':
+        compare_loaders(args.csv_file, args.repeat)
+    elif args.command == 'startup':
+        if not compare_startup(args.repeat, args.max_seconds):
+            sys.exit(1)
+    elif args.command == 'generate':
+        activities = args.activities or default_activities(args.students, args.capacity)
+        generate_cohort(args.csv_file, args.students, args.days, activities, args.skew,
+                        args.priority_mix, args.capacity, args.seed)
+        print(f"Wrote {args.students} students x {args.days} days to {args.csv_file}")
+    elif args.command == 'suite':
+        run_suite(args)
+
+if __name__ == '__main__':
+    main()
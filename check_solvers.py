@@ -0,0 +1,212 @@
+###
+### Regression check for the hand-written solvers of the Activity Assignment
+### Algorithm (AAA): compares the flow solvers with networkx on random small
+### networks and reassign_students with a full allocate on random deltas, and
+### exits with status 1 on any mismatch
+###
+
+import argparse
+import sys
+
+import numpy as np
+
+import auto_assign
+
+def random_table(rng, rows, days, activities):
+    # One student per row so every row is its own student-day node; choices
+    # are three distinct activities
+    choices = rng.random((rows, activities)).argsort(axis=1)[:, :3].astype(np.int32)
+    return auto_assign.PreferenceTable(
+        [f"S{row}" for row in range(rows)],
+        [f"d{day}" for day in range(days)],
+        [f"A{activity}" for activity in range(activities)],
+        np.arange(rows, dtype=np.int32),
+        rng.integers(0, days, size=rows).astype(np.int16),
+        choices,
+        rng.integers(0, len(auto_assign.PRIORITY_LEVELS), size=rows).astype(np.int8),
+    )
+
+def random_graph(rng, max_nodes):
+    # Arbitrary digraph over the source, the sink and up to max_nodes - 2
+    # inner nodes, with random capacities and non-negative weights
+    inner = int(rng.integers(1, max_nodes - 1))
+    table = random_table(rng, inner, 1, 3)
+    index = auto_assign.NodeIndex(table)
+    nodes = [auto_assign.SOURCE, auto_assign.SINK] + [index.student_day(row) for row in range(inner)]
+    network = auto_assign.FlowNetwork(index)
+    for _ in range(int(rng.integers(1, 4 * len(nodes)))):
+        u, v = rng.choice(nodes, size=2, replace=False).tolist()
+        if u == auto_assign.SINK or v == auto_assign.SOURCE:
+            continue
+        network.add_edge(u, v, capacity=int(rng.integers(1, 6)), weight=int(rng.integers(0, 10)))
+    return network
+
+def random_cohort(rng, max_students):
+    # The global mode's weighted network over a random cohort with tight,
+    # random capacities
+    students = int(rng.integers(1, max_students + 1))
+    days = int(rng.integers(1, 3))
+    activities = int(rng.integers(3, 7))
+    table = random_table(rng, students, days, activities)
+    capacities = {
+        (day, activity): int(rng.integers(0, 4)) for day in table.days for activity in table.activities
+    }
+    return auto_assign.build_flow_network(table, None, 2, capacities)
+
+def random_round(rng, max_students):
+    # A greedy round network, where the bucket fill fast path applies
+    students = int(rng.integers(1, max_students + 1))
+    table = random_table(rng, students, 2, int(rng.integers(3, 7)))
+    remaining = rng.integers(0, 4, size=(len(table.days), len(table.activities)))
+    level = auto_assign.PREFERENCE_LEVELS[int(rng.integers(0, 3))]
+    return auto_assign.create_priority_network(table, np.arange(students), remaining, level)
+
+def flow_errors(network, flow_value, edge_flow):
+    # Capacity, conservation and value of a flow; returns a list of problems
+    errors = []
+    balance = {}
+    for u, v, capacity, flow in zip(network.tail, network.head, network.capacity, edge_flow):
+        if not 0 <= flow <= capacity:
+            errors.append(f"flow {flow} on edge {u}->{v} outside [0, {capacity}]")
+        balance[u] = balance.get(u, 0) - flow
+        balance[v] = balance.get(v, 0) + flow
+    for node, value in balance.items():
+        if node not in (auto_assign.SOURCE, auto_assign.SINK) and value:
+            errors.append(f"flow not conserved at node {node} ({value:+})")
+    if -balance.get(auto_assign.SOURCE, 0) != flow_value:
+        errors.append(f"source sends {-balance.get(auto_assign.SOURCE, 0)}, reported {flow_value}")
+    return errors
+
+def check_network(network):
+    # Returns a list of mismatches between the solvers and networkx
+    errors = []
+    reference_value, _ = auto_assign.networkx_max_flow(network)
+    reference_min_value, reference_flow = auto_assign.networkx_min_cost_flow(network)
+    reference_cost = auto_assign.flow_cost(network, reference_flow)
+
+    flow_value, edge_flow = auto_assign.dinic_max_flow(network)
+    if flow_value != reference_value:
+        errors.append(f"dinic max flow {flow_value} != networkx {reference_value}")
+    errors.extend(f"dinic: {error}" for error in flow_errors(network, flow_value, edge_flow))
+
+    flow_value, edge_flow = auto_assign.primal_dual_min_cost_flow(network)
+    cost = auto_assign.flow_cost(network, edge_flow)
+    if (flow_value, cost) != (reference_min_value, reference_cost):
+        errors.append(f"primal-dual flow {flow_value} cost {cost} != networkx flow {reference_min_value} "
+                      f"cost {reference_cost}")
+    errors.extend(f"primal-dual: {error}" for error in flow_errors(network, flow_value, edge_flow))
+
+    solution = auto_assign.bucket_fill_max_flow(network)
+    if solution is not None:
+        flow_value, edge_flow = solution
+        if flow_value != reference_value:
+            errors.append(f"bucket fill max flow {flow_value} != networkx {reference_value}")
+        errors.extend(f"bucket fill: {error}" for error in flow_errors(network, flow_value, edge_flow))
+    return errors
+
+def random_students(rng, count, days, activities, first_id=0):
+    # {student_id: Student} with a random priority and one to all of the days
+    students = {}
+    for number in range(first_id, first_id + count):
+        student = auto_assign.Student(f"S{number}", auto_assign.PRIORITY_LEVELS[int(rng.integers(0, 3))])
+        for day in rng.permutation(days)[:int(rng.integers(1, len(days) + 1))].tolist():
+            student.set_day(auto_assign.StudentDay(day, *rng.permutation(activities)[:3].tolist()))
+        students[student.student_id] = student
+    return students
+
+def random_changes(rng, students, days, activities):
+    # A few withdrawals, changed days, new priorities and new students
+    changes = {}
+    ids = list(students)
+    for student_id in rng.permutation(ids)[:int(rng.integers(1, max(len(ids) // 3, 1) + 1))].tolist():
+        kind = int(rng.integers(0, 4))
+        if kind == 0:
+            changes[student_id] = None
+        elif kind == 1:
+            changes[student_id] = {'days': {str(rng.choice(days)): None}}
+        elif kind == 2:
+            choices = rng.permutation(activities)[:3].tolist()
+            changes[student_id] = {'days': {str(rng.choice(days)): dict(zip(
+                (f'{level}_preference' for level in auto_assign.PREFERENCE_LEVELS), choices
+            ))}}
+        else:
+            changes[student_id] = {'weight': auto_assign.PRIORITY_LEVELS[int(rng.integers(0, 3))]}
+    changes.update(random_students(rng, int(rng.integers(0, 3)), days, activities, first_id=len(ids)))
+    return changes
+
+def check_repair(rng, max_students):
+    # Allocates a random cohort, applies random changes (and sometimes a new
+    # capacity) with reassign_students and compares the repair with a full
+    # allocate on the updated table; returns a list of mismatches
+    days = ['mon', 'tue']
+    activities = [f"A{activity}" for activity in range(int(rng.integers(3, 7)))]
+    students = random_students(rng, int(rng.integers(1, max_students + 1)), days, activities)
+    capacity = int(rng.integers(1, 4))
+    assignments = auto_assign.allocate(students, max_capacity_per_activity=capacity).assignments
+
+    changes = random_changes(rng, students, days, activities)
+    new_capacity = int(rng.integers(0, 4)) if rng.random() < 0.3 else capacity
+    capacities = {('mon', activities[0]): int(rng.integers(0, 3))} if rng.random() < 0.3 else None
+    table, repaired, _ = auto_assign.reassign_students(
+        students, assignments, changes, max_capacity_per_activity=new_capacity, capacities=capacities
+    )
+    if table is None:
+        return ["reassign_students failed"]
+    expected = {}
+    if len(table):
+        expected = auto_assign.allocate(table, capacities, max_capacity_per_activity=new_capacity).assignments
+    if repaired != expected:
+        return [f"repair {repaired} != allocate {expected} after {changes}"]
+    return []
+
+FAMILIES = {
+    'graph': random_graph,
+    'cohort': random_cohort,
+    'round': random_round,
+}
+
+def run_checks(count, seed, size):
+    rng = np.random.default_rng(seed)
+    failures = 0
+    print(f"{'Family':^10} | {'Networks':^10} | {'Failures':^10}")
+    print("-" * 36)
+    for name, make_network in FAMILIES.items():
+        family_failures = 0
+        for number in range(count):
+            network = make_network(rng, size)
+            errors = check_network(network)
+            if errors:
+                family_failures += 1
+                if family_failures <= 3:
+                    print(f"{name} #{number} ({network.num_nodes} nodes, {network.num_edges} edges):")
+                    for error in errors:
+                        print(f"  {error}")
+        print(f"{name:^10} | {count:^10} | {family_failures:^10}")
+        failures += family_failures
+
+    repair_failures = 0
+    for number in range(count):
+        errors = check_repair(rng, size)
+        if errors:
+            repair_failures += 1
+            if repair_failures <= 3:
+                print(f"repair #{number}:")
+                for error in errors:
+                    print(f"  {error}")
+    print(f"{'repair':^10} | {count:^10} | {repair_failures:^10}")
+    return failures + repair_failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the flow solvers with networkx on random networks')
+    parser.add_argument('--count', type=int, default=300, help='Random networks per family')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--size', type=int, default=12,
+                        help='Largest number of nodes (graph) or students (cohort, round, repair)')
+    args = parser.parse_args()
+    if args.size < 3:
+        parser.error('--size must be at least 3')
+    if run_checks(args.count, args.seed, args.size):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()